@@ -0,0 +1,383 @@
+# End-to-end benchmark of the bib_maker pipeline, without the network.
+#
+# Usage: python3 benchmarks/pipeline.py [--sizes=10,1000,10000] [--repeat=N]
+#                                       [--jobs=N] [--output=results.json]
+#
+# A local stand-in server replays the responses of doi.org, crossref, arXiv
+# and a journal website from the files in benchmarks/fixtures, and the shared
+# HTTP client of bib_maker is pointed at it. Each stage of the pipeline is
+# timed on a synthetic bbl file with the given numbers of references:
+#
+#   bbl_extraction  reading the bbl file and resolving the arXiv identifiers
+#   doi_fetch       downloading the metadata of all DOIs
+#   pybtex_parse    assigning the labels and parsing the bibtex entries
+#   page_fixups     filling in the missing pages from the journal rules
+#   title_cleanup   removing the MathML and HTML markup
+#   abbreviation    abbreviating the journal names
+#
+# and the whole build is timed once more through BibBuilder. The results are
+# printed as JSON (the best time of the repeats, in seconds), so that the
+# files of two versions can be compared.
+
+import getopt
+import http.server
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(SCRIPT_DIR, 'fixtures')
+sys.path.insert(0, os.path.join(SCRIPT_DIR, os.pardir))
+
+import pybtex.database
+from pybtex.database import BibliographyData
+
+import bib_maker
+from bib_maker import Options
+
+HOSTS = ['doi.org', 'api.crossref.org', 'export.arxiv.org', 'www.nature.com']
+
+STAGES = ['bbl_extraction', 'doi_fetch', 'pybtex_parse', 'page_fixups',
+          'title_cleanup', 'abbreviation']
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'r', encoding='utf-8') as myfile:
+        return myfile.read()
+
+
+def fill(template, **values):
+    """ Replace the @NAME@ placeholders of a fixture.
+    """
+    for name, value in values.items():
+        template = template.replace('@' + name + '@', str(value))
+    return template
+
+
+# the synthetic references cycle through these kinds, which together go
+# through every stage: crossref with article numbers, crossref without pages
+# (scraped from the journal website, or taken from the DOI), and arXiv
+# preprints (arXiv API, then doi.org)
+KINDS = ['prb', 'ncomms', 'scipost', 'arxiv']
+
+
+def make_reference(ind):
+    """ Returns (kind, DOI or arXiv identifier) of the ind-th reference.
+    """
+    kind = KINDS[ind % len(KINDS)]
+    if kind == 'prb':
+        return kind, '10.1103/PhysRevB.96.' + str(100000 + ind)
+    if kind == 'ncomms':
+        return kind, '10.1038/s41467-020-' + str(10000 + ind) + '-z'
+    if kind == 'scipost':
+        return kind, '10.21468/SciPostPhys.10.' + str(ind)
+    return kind, '2005.' + str(ind).zfill(5)
+
+
+def make_bbl(size):
+    """ A revtex style bbl file with size references.
+    """
+    lines = ['\\begin{thebibliography}{' + str(size) + '}%',
+             '\\makeatletter',
+             '\\providecommand \\@ifxundefined [1]{%',
+             ' \\@ifx{#1\\undefined}',
+             '}%',
+             '\\providecommand \\BibitemOpen [0]{}%',
+             '\\providecommand \\bibitemStop [0]{}%',
+             '\\makeatother', '']
+
+    for ind in range(size):
+        kind, ident = make_reference(ind)
+        lines.append('\\bibitem [{\\citenamefont {Author}\\ \\emph {et~al.}'
+                     '(2020)}]{ref' + str(ind) + '}%')
+        lines.append('  \\BibitemOpen')
+        lines.append('  \\bibfield  {author} {\\bibinfo {author} '
+                     '{\\bibfnamefont {A.}~\\bibnamefont {Author}}},\\ ')
+        if kind == 'arxiv':
+            lines.append('  \\bibfield  {journal} {\\bibinfo  {journal} '
+                         '{arXiv preprint}\\ }\\Eprint '
+                         '{https://arxiv.org/abs/' + ident + '} {arXiv:' +
+                         ident + '} (\\bibinfo {year} {2020})')
+        else:
+            lines.append('  \\href {\\doibase ' + ident + '} {\\bibfield '
+                         '{journal} {\\bibinfo  {journal} {Journal}\\ }'
+                         '\\textbf {\\bibinfo {volume} {1}},\\ \\bibinfo '
+                         '{pages} {1} (\\bibinfo {year} {2020})}')
+        lines.append('  \\BibitemShut {NoStop}%')
+
+    lines.append('\\end{thebibliography}%')
+    return '\n'.join(lines) + '\n'
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers like doi.org, crossref, arXiv and nature.com, telling them
+        apart by the Host header.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        host = self.headers.get('Host', '').split(':')[0]
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        self.server.count(host)
+
+        if host == 'api.crossref.org':
+            items = []
+            for doi_filter in query.get('filter', [''])[0].split(','):
+                item = self.server.crossref_work(doi_filter[len('doi:'):])
+                if item is not None:
+                    items.append(item)
+
+            body = json.dumps({'status': 'ok', 'message-type': 'work-list',
+                               'message': {'items': items,
+                                           'total-results': len(items)}})
+            return self.send(200, body, 'application/json')
+
+        if host == 'export.arxiv.org':
+            entries = [fill(self.server.fixtures['arxiv_entry'], ID=arXiv_id)
+                       for arXiv_id in query.get('id_list', [''])[0].split(',')
+                       if len(arXiv_id) > 0]
+            body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<feed xmlns="http://www.w3.org/2005/Atom">\n' +
+                    ''.join(entries) + '</feed>\n')
+            return self.send(200, body, 'application/atom+xml')
+
+        if host == 'doi.org':
+            DOI = urllib.parse.unquote(parts.path[1:])
+            if self.headers.get('Accept', '').find('bibtex') > -1:
+                if DOI.lower().startswith('10.48550/arxiv.'):
+                    body = fill(self.server.fixtures['arxiv_bibtex'], DOI=DOI,
+                                DOI_LOWER=DOI.lower(),
+                                ID=DOI[len('10.48550/arXiv.'):])
+                    return self.send(200, body, 'application/x-bibtex')
+                return self.send(404, 'DOI not found', 'text/plain')
+
+            if DOI.startswith('10.1038/'):
+                self.send_response(302)
+                self.send_header('Location', 'https://www.nature.com/articles/'
+                                 + DOI[len('10.1038/'):])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            return self.send(404, 'DOI not found', 'text/plain')
+
+        if host == 'www.nature.com' and parts.path.startswith('/articles/'):
+            suffix = parts.path[len('/articles/'):]
+            body = fill(self.server.fixtures['ncomms_landing'],
+                        DOI='10.1038/' + suffix,
+                        N=suffix.split('-')[2].lstrip('0') or '0')
+            return self.send(200, body, 'text/html')
+
+        return self.send(404, 'not found', 'text/plain')
+
+    def send(self, status, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.fixtures = {name: read_fixture(filename) for name, filename in
+                         [('prb', 'crossref_prb.json'),
+                          ('ncomms', 'crossref_ncomms.json'),
+                          ('scipost', 'crossref_scipost.json'),
+                          ('arxiv_entry', 'arxiv_entry.xml'),
+                          ('arxiv_bibtex', 'arxiv_bibtex.bib'),
+                          ('ncomms_landing', 'ncomms_landing.html')]}
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    def count(self, host):
+        with self.lock:
+            self.requests[host] = self.requests.get(host, 0) + 1
+
+    def crossref_work(self, DOI):
+        """ The metadata of one of the synthetic DOIs, or None for the ones
+            that crossref does not know (arXiv).
+        """
+        if DOI.startswith('10.1103/physrevb.'):
+            kind = 'prb'
+        elif DOI.startswith('10.1038/'):
+            kind = 'ncomms'
+        elif DOI.startswith('10.21468/'):
+            kind = 'scipost'
+        else:
+            return None
+
+        # crossref answers with the DOI in its registered case
+        if kind == 'prb':
+            DOI = DOI.replace('physrevb', 'PhysRevB')
+        elif kind == 'scipost':
+            DOI = DOI.replace('scipostphys', 'SciPostPhys')
+        work = fill(self.fixtures[kind], DOI=DOI, N=DOI.split('.')[-1])
+        return json.loads(work)
+
+
+def best_of(repeat, function):
+    """ Returns the result of the last call and the best time.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return result, best
+
+
+def run_stages(size, options, repeat):
+    """ Returns the times of every stage for a bbl file of this size.
+    """
+    bbl = make_bbl(size)
+    times = {}
+
+    doi_requests, times['bbl_extraction'] = best_of(repeat,
+        lambda: bib_maker.extract_input_from_bbl(io.StringIO(bbl), options))
+
+    outputs, times['doi_fetch'] = best_of(repeat,
+        lambda: bib_maker.fetch_all_bibtex([DOI for label, DOI in
+                                            doi_requests], options))
+
+    # the first step of bib_maker.finalize_entry(), the later ones are timed
+    # separately below
+    def parse():
+        labelled = bib_maker.assign_labels(doi_requests, outputs, options)
+        return [(label, DOI, bib_maker.parse_entry(label, DOI, output, options))
+                for label, DOI, output in labelled]
+
+    entries, times['pybtex_parse'] = best_of(repeat, parse)
+
+    def fix_pages(item):
+        label, DOI, entry = item
+        if 'pages' in entry.fields or 'journal' not in entry.fields or \
+           DOI.lower().find('arxiv') > -1:
+            return None
+        return bib_maker.get_pages_by_rule(entry, DOI, options)
+
+    def page_fixups():
+        with ThreadPoolExecutor(max_workers=max(1, options.jobs)) as pool:
+            return list(pool.map(fix_pages, entries))
+
+    pages, times['page_fixups'] = best_of(repeat, page_fixups)
+
+    # the later stages change the entries, so time them on fresh copies
+    def title_cleanup():
+        for label, DOI, entry in entries:
+            fields = dict(entry.fields)
+            for name in fields:
+                if name not in bib_maker.UNCLEANED_FIELDS:
+                    fields[name] = bib_maker.clean_markup(fields[name])
+
+    _, times['title_cleanup'] = best_of(repeat, title_cleanup)
+
+    def abbreviation():
+        bib = BibliographyData()
+        for label, DOI, entry in entries:
+            bib.add_entry(label, pybtex.database.Entry(entry.type,
+                                                       dict(entry.fields)))
+        bib_maker.abbreviate_journal_names(bib, options)
+        return bib
+
+    bib, times['abbreviation'] = best_of(repeat, abbreviation)
+
+    builder = bib_maker.BibBuilder(options)
+    full, times['end_to_end'] = best_of(repeat,
+        lambda: builder.build(bib_maker.extract_input_from_bbl(
+                                                io.StringIO(bbl), options)))
+
+    return {'references': size,
+            'entries': len(full.entries),
+            'missing_pages': len(bib_maker.missing_pages(full)),
+            'pages_found': sum(page is not None for page in pages),
+            'seconds': times}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=SCRIPT_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    sizes = [10, 1000, 10000]
+    repeat = 1
+    jobs = bib_maker.JOBS
+    output = None
+
+    opts, args = getopt.getopt(sys.argv[1:], '',
+                               ['sizes=', 'repeat=', 'jobs=', 'output='])
+    for opt, arg in opts:
+        if opt == '--sizes':
+            sizes = [int(size) for size in arg.split(',')]
+        elif opt == '--repeat':
+            repeat = int(arg)
+        elif opt == '--jobs':
+            jobs = int(arg)
+        elif opt == '--output':
+            output = arg
+
+    server = StandInServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:' + str(server.server_address[1])
+
+    # no rate limits for the stand-in server, and no cache, so that every
+    # run does the same requests
+    bib_maker.set_http_client(bib_maker.HTTPClient(
+        host_map={host: base_url for host in HOSTS},
+        rate_limits={host: (1e9, 1e9) for host in HOSTS}))
+    options = Options(force=True, experimental=True, jobs=jobs, cache=None)
+
+    results = {'benchmark': 'pipeline',
+               'commit': git_commit(),
+               'python': platform.python_version(),
+               'jobs': jobs,
+               'repeat': repeat,
+               'runs': []}
+
+    for size in sizes:
+        with server.lock:
+            server.requests = {}
+        run = run_stages(size, options, repeat)
+        run['requests'] = dict(server.requests)
+        results['runs'].append(run)
+
+        print(f"{size:6d} references: " +
+              '  '.join(f"{stage} {run['seconds'][stage]:.3f}s"
+                        for stage in STAGES + ['end_to_end']),
+              file=sys.stderr)
+
+    bib_maker.set_http_client(None)
+    server.shutdown()
+
+    text = json.dumps(results, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as outfile:
+            print(text, file=outfile)
+
+
+if __name__ == '__main__':
+    main()
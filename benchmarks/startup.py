@@ -0,0 +1,60 @@
+# Cold start benchmark for bib_maker.
+#
+# Usage: python3 benchmarks/startup.py [repeats]
+#
+# Runs `python3 bib_maker.py --help` in a fresh interpreter several times and
+# prints the best and the median wall time. For comparison, it also times the
+# imports that bib_maker used to need at startup (pandas and numpy), if they
+# are installed.
+
+import os
+import subprocess
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BIB_MAKER = os.path.join(SCRIPT_DIR, os.pardir, 'bib_maker.py')
+
+
+def time_command(command, repeats):
+    """ Returns the wall times of running the command repeatedly.
+    """
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - start)
+
+    return sorted(times)
+
+
+def report(name, times):
+    print(f"{name:32s} best {1000*times[0]:8.1f} ms   "
+          f"median {1000*times[len(times)//2]:8.1f} ms")
+
+
+def main():
+    repeats = 20
+    if len(sys.argv) > 1:
+        repeats = int(sys.argv[1])
+
+    report('python3 (empty)',
+           time_command([sys.executable, '-c', 'pass'], repeats))
+    report('python3 bib_maker.py --help',
+           time_command([sys.executable, BIB_MAKER, '--help'], repeats))
+
+    for module in ['pandas', 'numpy']:
+        if subprocess.run([sys.executable, '-c', 'import ' + module],
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode != 0:
+            print(f"{'import ' + module:32s} not installed")
+            continue
+
+        report('import ' + module,
+               time_command([sys.executable, '-c', 'import ' + module],
+                            repeats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# Micro-benchmark of the title cleanup.
+#
+# Usage: python3 benchmarks/title_cleanup.py [number of MathML nodes]
+#
+# Compares clean_markup() with the two find() loops that used to strip the
+# MathML tags from titles, on a title with many MathML nodes. It first checks
+# that the markup becomes valid LaTeX, also once written as bibtex.
+
+import os
+import sys
+import timeit
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, os.pardir))
+
+from bib_maker import clean_markup, BibRecord, Bibliography
+
+
+def strip_mathml_loops(mytitle):
+    """ The old title cleanup, for comparison.
+    """
+    fix_title = True
+    while fix_title:
+        ind1 = mytitle.find('<mml')
+        temptitle = mytitle[ind1+3:]
+        ind2 = temptitle.find('>')
+        if ind2 > -1 and ind1 > -1:
+            mytitle = mytitle[:ind1] + temptitle[ind2+1:]
+        else:
+            fix_title = False
+
+    fix_title = True
+    while fix_title:
+        ind1 = mytitle.find('</mml')
+        temptitle = mytitle[ind1+4:]
+        ind2 = temptitle.find('>')
+        if ind2 > -1 and ind1 > -1:
+            mytitle = mytitle[:ind1] + temptitle[ind2+1:]
+        else:
+            fix_title = False
+
+    return mytitle
+
+
+# markup -> LaTeX, and how the LaTeX is written in a bib file
+CHECKS = [('T<sub>c</sub> of MnBi<sub>2</sub>Te<sub>4</sub>',
+           'T$_{c}$ of MnBi$_{2}$Te$_{4}$',
+           'T$_{c}$ of MnBi$_{2}$Te$_{4}$'),
+          ('x<sup>2</sup> &amp; <i>y</i>',
+           'x$^{2}$ & \\textit{y}',
+           'x$^{2}$ \\& \\textit{y}'),
+          ('<mml:math><mml:msub><mml:mi>Z</mml:mi><mml:mn>2</mml:mn>'
+           '</mml:msub></mml:math> phases',
+           '$Z_{2}$ phases',
+           '$Z_{2}$ phases'),
+          ('Laser &amp; Photonics Reviews',
+           'Laser & Photonics Reviews',
+           'Laser \\& Photonics Reviews')]
+
+
+def check():
+    """ Raises AssertionError if the cleanup, or the writers of BibRecord and
+        of the Bibliography returned by BibBuilder.build(), get one of the
+        CHECKS wrong.
+    """
+    for markup, latex, bibtex in CHECKS:
+        assert clean_markup(markup) == latex, (markup, clean_markup(markup))
+
+        record = BibRecord('article', 'key', {'title': latex})
+        assert record.to_bibtex().find('title = "' + bibtex + '"') > -1, \
+               record.to_bibtex()
+
+        bib = Bibliography()
+        bib.add_entry('key', record.to_entry())
+        assert bib.to_string('bibtex').find('title = "' + bibtex + '"') > -1, \
+               bib.to_string('bibtex')
+
+
+def make_title(nodes):
+    formula = ('<mml:math xmlns:mml="http://www.w3.org/1998/Math/MathML">'
+               '<mml:msub><mml:mi>Z</mml:mi><mml:mn>2</mml:mn></mml:msub>'
+               '</mml:math>')
+    # every formula has 4 elements
+    return ' and '.join(['Topological phases with ' + formula
+                         for i in range(max(1, nodes // 4))])
+
+
+def main():
+    nodes = 40
+    if len(sys.argv) > 1:
+        nodes = int(sys.argv[1])
+
+    check()
+
+    title = make_title(nodes)
+    print('title with', nodes, 'MathML nodes,', len(title), 'characters')
+
+    functions = [('find() loops', strip_mathml_loops),
+                 ('clean_markup()', clean_markup)]
+    timers = [timeit.Timer(lambda function=function: function(title))
+              for name, function in functions]
+    numbers = [timer.autorange()[0] for timer in timers]
+
+    # alternate the rounds, and keep the least disturbed one of each
+    best = [float('inf')] * len(timers)
+    for _ in range(20):
+        for ind, timer in enumerate(timers):
+            best[ind] = min(best[ind], timer.timeit(numbers[ind]) / numbers[ind])
+
+    for (name, function), seconds in zip(functions, best):
+        print(f"{name:16s} {1e6 * seconds:10.1f} us per title")
+
+
+if __name__ == '__main__':
+    main()
@@ -25,23 +25,45 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-import pandas
-import numpy as np
 import sys
-import subprocess
 import getopt
+import io
+import http.server
+import csv
 import pybtex
 import string
-from pybtex.database import parse_file, BibliographyData, Entry
-from urllib.request import urlopen
+from pybtex.database import parse_file, BibliographyData, Entry, Person
+from pybtex.bibtex.utils import split_name_list
+from concurrent.futures import ThreadPoolExecutor
 import re
 import os
+import json
+import gzip
+import http.client
+import urllib.parse
+import sqlite3
+import threading
+import time
+import random
+import email.utils
+import xml.etree.ElementTree
+import unicodedata
+import html
+import contextlib
+import collections
+import glob
+import itertools
+import codecs
+import mmap
+import struct
+import zlib
 
 alphabet = string.ascii_lowercase
 
 def usage():
     print( """\
 Usage: python3 bib_maker.py [options] input_file output_file.bib
+       python3 bib_maker.py --batch [options] input_file|glob|directory ...
 
 Construct a bib file out of the data stored in the input file. 
 
@@ -53,21 +75,109 @@ desired label for the bib entry followed by a DOI.
 2) The input file is a bbl file. Then the code will attempt to read it, 
 extract all labels and DOIs, and use them to generate the output bib file. 
 This is an attempt to `clean' existing bbl files, and it will fail if the
-code doesen't manage to find the DOIs.
+code doesen't manage to find the DOIs. The labels and DOIs that were found
+are then written to input_file.dois.txt (for input_file.bbl), which can be
+fixed by hand and used as the input file.
 
 Options:
   -o, --overwrite       Overwrite the output file.
 
+  -u, --update          Update the output file: keep the entries that are
+                        still listed in the input file as they are, fetch
+                        only the new or changed DOIs, and drop the entries
+                        that are no longer listed.
+
   -h, --help            Print this message and exit.
 
   -v, --verbose         Print text showing current progress.
 
-  -e, --experimental    Use the `lynx' terminal browser to scrape some journal
-                        websites that cannot be easily accessed using urlopen.
+  -e, --experimental    Scrape some journal websites (sciencedirect.com) for
+                        the DOIs in bbl files, and ask crossref for the page
+                        numbers of some journals.
 
   -f, --force           Proceed with processing the DOIs even if not all were
                         found in the bib file.
 
+  -j N, --jobs N        Number of DOIs fetched in parallel (default: 8). Use
+                        1 to fetch them one at a time.
+
+  --no-cache            Do not read or write the metadata cache.
+
+  --refresh             Download everything again and update the cache.
+
+  --cache-ttl DAYS      Cached metadata older than this is downloaded again
+                        (default: 30).
+
+  --cache-size N        Maximum number of cached items, the least recently
+                        used ones are dropped first (default: 100000).
+
+  The cache is stored in ~/.cache/bib_maker/cache.sqlite, or in the file
+  given by the BIB_MAKER_CACHE environment variable.
+
+  --serve               Run as a server on 127.0.0.1 that builds bib files
+                        on request, keeping the cache, the journal lists and
+                        the connections warm in between. No input or output
+                        file is needed.
+
+  --port N              Port of the server (default: 8765).
+
+  --server URL          Let the server at URL (e.g. http://127.0.0.1:8765)
+                        build the bib file, instead of building it here.
+
+  --dump FILE           Look up the crossref metadata in the offline index
+                        FILE first, and only ask crossref for the DOIs that
+                        are not in it.
+
+  --ingest SNAPSHOT     Add the works of a crossref metadata snapshot to the
+                        index given by --dump first. The snapshot is a
+                        JSON-lines file, possibly gzipped, with one work, or
+                        one object with a list of "items", per line. No input
+                        or output file is needed.
+
+  --resolvers LIST      Where to look up the crossref metadata, in order:
+                        dump, crossref, or both (default: dump,crossref with
+                        --dump, crossref otherwise). Use --resolvers dump to
+                        never ask crossref: the DOIs that are not in the dump
+                        are then not found, instead of being downloaded from
+                        doi.org.
+
+  --fuzzy               Abbreviate the journals that are not in the list
+                        with the closest name in the list, if it is close
+                        enough. The names matched this way are printed at
+                        the end, so that they can be added to the list.
+
+  --fuzzy-threshold X   How close the names must be, between 0 and 1
+                        (default: 0.8). A journal with a subtitle (after a
+                        colon) is also compared without it, with its score
+                        multiplied by 0.75, so that this is only used with a
+                        threshold of 0.75 or less.
+
+  --compile-abbreviations CSV[,CSV...]
+                        Compile the journal abbreviations of the CSV files
+                        (e.g. all the lists of abbrv.jabref.org) into the
+                        index that is used for abbreviating, and exit.
+                        journal_abbreviations.csv is always included, and
+                        wins over the other lists. By default, the index is
+                        only compiled from journal_abbreviations.csv. Every
+                        copy of bib_maker has its own index.
+
+  --batch               Build the bib files of many documents at once. The
+                        arguments are input files, glob patterns (e.g.
+                        'papers/*/main.bbl'), or directories, in which all
+                        bbl files are used. The bib file of every input file
+                        is written next to it, with the extension .bib. The
+                        DOIs cited by several documents are fetched once.
+
+  --output-dir DIR      Write the bib files of --batch to DIR instead.
+
+  --profile             Print where the time went at the end: the time of
+                        every stage and of the requests to every host, the
+                        cache hits and misses, the retries, and the slowest
+                        DOIs. With --serve, this is printed when the server
+                        stops.
+
+  --profile-json FILE   Write the same report to FILE as JSON.
+
 Note:
   - This has been written using pybtex version 0.24.0
   - If you find that some journal abbreviations are missing, please help me
@@ -80,9 +190,72 @@ DEBUG_MODE = True # set this to false in the final version
 
 BIB_FILE = None
 INPUT_FILE = None
+BATCH = False
+BATCH_INPUTS = [] # input files, globs and directories of the batch mode
+OUTPUT_DIR = None
 OVERWRITE = False
+UPDATE = False
 VERBOSE = False
 FORCE = False
+JOBS = 8
+
+# server mode, see serve()
+SERVE = False
+PORT = 8765
+SERVER = None # URL of the server used by the client
+SERVER_TIMEOUT = None # in seconds, how long the client waits for a build
+
+# offline crossref metadata, see CrossrefDump
+DUMP_FILE = None
+INGEST_FILES = []
+RESOLVER_NAMES = None
+RESOLVERS = None
+DUMP = None
+
+# instrumentation, see Profiler
+PROFILE = False
+PROFILE_JSON = None
+PROFILER = None
+PROFILE_SLOWEST = 10 # number of slowest DOIs in the report
+
+# downloaded metadata is kept in an on-disk cache between runs
+USE_CACHE = True
+REFRESH_CACHE = False
+CACHE_FILE = os.environ.get('BIB_MAKER_CACHE',
+                            os.path.join(os.path.expanduser('~'), '.cache',
+                                         'bib_maker', 'cache.sqlite'))
+CACHE_TTL = 30 * 24 * 3600 # in seconds
+CACHE_SIZE = 100000
+CACHE = None
+CACHE_MISS = object()
+
+# all downloads go through one shared HTTP client, see http_client()
+HTTP_TIMEOUT = 30 # in seconds
+HTTP_DEADLINE = 120 # in seconds, for a request including all its retries
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5 # in seconds, doubled after every retry
+# requests per second and burst size of each host, the others get
+# DEFAULT_RATE_LIMIT
+HOST_RATE_LIMITS = {'export.arxiv.org': (1/3, 1), # asked for by arXiv
+                    'api.crossref.org': (10, 10),
+                    'doi.org': (20, 20),
+                    'dx.doi.org': (20, 20),
+                   }
+DEFAULT_RATE_LIMIT = (10, 10)
+USER_AGENT = 'bib_maker (https://github.com/TopoMatter/bib_maker)'
+HTTP = None
+HTTP_LOCK = threading.Lock()
+
+# some journal websites only serve their pages to (text) browsers
+BROWSER_HEADERS = {'User-Agent': 'Lynx/2.9.0dev.12 libwww-FM/2.14',
+                   'Accept': 'text/html'}
+
+# the journal pages are only read until what is looked for, see scrape_page()
+SCRAPE_CHUNK = 16 * 1024 # in bytes
+SCRAPE_MAX_BYTES = 1024 * 1024 # in bytes, the most that is read of a page
+PUBLISHER_CONNECTIONS = 2 # pages of one publisher scraped at the same time
+PUBLISHER_SLOTS = {} # publisher -> semaphore
+PUBLISHER_SLOTS_LOCK = threading.Lock()
 
 if DEBUG_MODE:
     OVERWRITE = True
@@ -99,134 +272,1459 @@ def rtfm(s):
     sys.exit(1)
 
 
+class BibMakerError(Exception):
+    """ Raised by the library functions instead of exiting, e.g. when a DOI
+        cannot be found.
+    """
+
+
+class Options:
+    """ The settings of a build, see the command line options for their
+        meaning. cache is a MetadataCache, or None to download everything.
+        profile is a Profiler that records where the time goes, or None.
+        fuzzy is the threshold of the approximate matching of journal
+        names, see JournalMatcher, or None to only use exact matches.
+        resolvers is the list of the sources of crossref metadata, tried in
+        order, e.g. [CrossrefDump(filename), CrossrefAPI()]. The default is
+        [CrossrefAPI()].
+    """
+
+    def __init__(self, verbose=False, force=False, experimental=False,
+                 jobs=8, refresh=False, cache=None, profile=None,
+                 resolvers=None, fuzzy=None):
+        self.verbose = verbose
+        self.force = force
+        self.experimental = experimental
+        self.jobs = jobs
+        self.refresh = refresh
+        self.cache = cache
+        self.profile = profile
+        self.fuzzy = fuzzy
+        if resolvers is None:
+            resolvers = [CrossrefAPI()]
+        self.resolvers = resolvers
+
+
 def parse_args():
-    global BIB_FILE, INPUT_FILE, OVERWRITE, VERBOSE, EXPERIMENTAL, FORCE
+    global BIB_FILE, INPUT_FILE, OVERWRITE, UPDATE, VERBOSE, EXPERIMENTAL
+    global FORCE, JOBS
+    global USE_CACHE, REFRESH_CACHE, CACHE_TTL, CACHE_SIZE
+    global SERVE, PORT, SERVER, PROFILE, PROFILE_JSON
+    global BATCH, BATCH_INPUTS, OUTPUT_DIR
+    global DUMP_FILE, INGEST_FILES, RESOLVER_NAMES, COMPILE_ABBREVIATIONS
+    global FUZZY_THRESHOLD
 
     try:
         opts, remaining_args = \
-            getopt.getopt(sys.argv[1:],
-                          "ohvef",
-                          ["overwrite", "help", "verbose",
-                           "experimental", "force"])
+            getopt.gnu_getopt(sys.argv[1:],
+                              "ouhvefj:",
+                              ["overwrite", "update", "help", "verbose",
+                               "experimental", "force", "jobs=",
+                               "no-cache", "refresh", "cache-ttl=",
+                               "cache-size=", "serve", "port=", "server=",
+                               "profile", "profile-json=", "batch",
+                               "output-dir=", "dump=", "ingest=",
+                               "resolvers=", "compile-abbreviations=",
+                               "fuzzy", "fuzzy-threshold="])
     except getopt.GetoptError:
         rtfm("unrecognized option")
 
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        if o == "--serve":
+            SERVE = True
+        if o == "--batch":
+            BATCH = True
+        if o == "--ingest":
+            INGEST_FILES.append(a)
+        if o == "--compile-abbreviations":
+            COMPILE_ABBREVIATIONS = a.split(',')
+
+    if BATCH:
+        BATCH_INPUTS = remaining_args
+        if len(BATCH_INPUTS) == 0:
+            rtfm("missing input files")
+
     try:
         INPUT_FILE = remaining_args[0]
         BIB_FILE = remaining_args[1]
     except:
-        rtfm("missing in/out file")
-
-    if INPUT_FILE[-4:] == '.bbl':
-        extract_input_from_bbl(INPUT_FILE)
-        INPUT_FILE = 'temp.txt'
+        if not SERVE and not BATCH and len(INGEST_FILES) == 0 and \
+           COMPILE_ABBREVIATIONS is None:
+            rtfm("missing in/out file")
 
     for o, a in opts:
-        if o in ("-h", "--help"):
-            usage()
-            sys.exit()
         if o in ("-o", "--overwrite"):
             OVERWRITE = True
+        if o in ("-u", "--update"):
+            UPDATE = True
         if o in ("-v", "--verbose"):
             VERBOSE = True
         if o in ("-e", "--experimental"):
             EXPERIMENTAL = True
         if o in ("-f", "--force"):
             FORCE = True
+        if o in ("-j", "--jobs"):
+            try:
+                JOBS = int(a)
+            except ValueError:
+                rtfm("the number of jobs must be an integer")
+            if JOBS < 1:
+                rtfm("the number of jobs must be at least 1")
+        if o == "--no-cache":
+            USE_CACHE = False
+        if o == "--refresh":
+            REFRESH_CACHE = True
+        if o == "--cache-ttl":
+            try:
+                CACHE_TTL = float(a) * 24 * 3600
+            except ValueError:
+                rtfm("the cache TTL must be a number of days")
+        if o == "--cache-size":
+            try:
+                CACHE_SIZE = int(a)
+            except ValueError:
+                rtfm("the cache size must be an integer")
+        if o == "--port":
+            try:
+                PORT = int(a)
+            except ValueError:
+                rtfm("the port must be an integer")
+        if o == "--server":
+            SERVER = a
+        if o == "--profile":
+            PROFILE = True
+        if o == "--profile-json":
+            PROFILE_JSON = a
+        if o == "--output-dir":
+            OUTPUT_DIR = a
+        if o == "--dump":
+            DUMP_FILE = a
+        if o == "--fuzzy" and FUZZY_THRESHOLD is None:
+            FUZZY_THRESHOLD = DEFAULT_FUZZY_THRESHOLD
+        if o == "--fuzzy-threshold":
+            try:
+                FUZZY_THRESHOLD = float(a)
+            except ValueError:
+                rtfm("the fuzzy threshold must be a number")
+            if not 0 <= FUZZY_THRESHOLD <= 1:
+                rtfm("the fuzzy threshold must be between 0 and 1")
+        if o == "--resolvers":
+            RESOLVER_NAMES = [name.strip() for name in a.split(',')]
+            for name in RESOLVER_NAMES:
+                if name not in ('dump', 'crossref'):
+                    rtfm("unknown resolver " + name)
+
+    if SERVER is not None and UPDATE:
+        rtfm("--update cannot be used with --server")
+    if BATCH and (UPDATE or SERVER is not None or SERVE):
+        rtfm("--batch cannot be used with --update, --server or --serve")
+    if DUMP_FILE is None and (len(INGEST_FILES) > 0 or
+                              'dump' in (RESOLVER_NAMES or [])):
+        rtfm("--ingest and the dump resolver need --dump")
+
+
+class MetadataCache:
+    """ Persistent on-disk cache of downloaded metadata, stored in a single
+        SQLite file. Entries are keyed by (kind, key), expire after `ttl`
+        seconds, and the least recently used ones are evicted once there are
+        more than `max_entries` of them.
+    """
+
+    def __init__(self, filename, ttl=CACHE_TTL, max_entries=CACHE_SIZE):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.puts_since_eviction = 0
+
+        cachedir = os.path.dirname(filename)
+        if cachedir != '':
+            os.makedirs(cachedir, exist_ok=True)
+
+        # every write is its own transaction, so the file is never left in a
+        # half-written state, even if the run is interrupted
+        self.db = sqlite3.connect(filename, timeout=30,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                            'kind TEXT NOT NULL, key TEXT NOT NULL, '
+                            'value TEXT NOT NULL, created REAL NOT NULL, '
+                            'last_used REAL NOT NULL, '
+                            'PRIMARY KEY (kind, key))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS metadata_last_used '
+                            'ON metadata (last_used)')
+
+    def get(self, kind, key):
+        """ Return the cached value, or CACHE_MISS if there is none or it
+            has expired.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT value, created FROM metadata '
+                                  'WHERE kind = ? AND key = ?',
+                                  (kind, key)).fetchone()
+            if row is None:
+                return CACHE_MISS
+
+            if self.ttl is not None and now - row[1] > self.ttl:
+                with self.db:
+                    self.db.execute('DELETE FROM metadata '
+                                    'WHERE kind = ? AND key = ?', (kind, key))
+                return CACHE_MISS
+
+            with self.db:
+                self.db.execute('UPDATE metadata SET last_used = ? '
+                                'WHERE kind = ? AND key = ?',
+                                (now, kind, key))
+
+        return json.loads(row[0])
+
+    def put(self, kind, key, value):
+        now = time.time()
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO metadata '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (kind, key, json.dumps(value), now, now))
+
+            self.puts_since_eviction += 1
+            if self.puts_since_eviction >= 100:
+                self._evict()
+
+    def _evict(self):
+        """ Drop the least recently used entries above max_entries. The lock
+            must be held by the caller.
+        """
+        self.puts_since_eviction = 0
+        if self.max_entries is None:
+            return
+
+        count = self.db.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+        if count <= self.max_entries:
+            return
+
+        with self.db:
+            self.db.execute('DELETE FROM metadata WHERE rowid IN ('
+                            'SELECT rowid FROM metadata '
+                            'ORDER BY last_used LIMIT ?)',
+                            (count - self.max_entries,))
+
+    def close(self):
+        with self.lock:
+            self._evict()
+            self.db.close()
+
+
+def open_cache():
+    """ Open the metadata cache, unless it has been disabled.
+    """
+    global CACHE
+
+    if not USE_CACHE:
+        CACHE = None
+        return
+
+    try:
+        CACHE = MetadataCache(CACHE_FILE, CACHE_TTL, CACHE_SIZE)
+    except (OSError, sqlite3.Error) as e:
+        # a broken cache should never stop the bib file from being built
+        print('### Could not open the cache ' + CACHE_FILE + ': ' + str(e))
+        CACHE = None
+
+
+def close_cache():
+    global CACHE
+
+    if CACHE is not None:
+        CACHE.close()
+        CACHE = None
+
+
+def cached(kind, key, fetch, options, keep=lambda value: True):
+    """ Return the cached value of (kind, key), or call fetch() and store its
+        result. Results for which keep(result) is False (e.g. failed
+        downloads) are returned but not stored.
+    """
+    if options.cache is not None and not options.refresh:
+        value = options.cache.get(kind, key)
+        if value is not CACHE_MISS:
+            profile_count(options, 'cache hits')
+            return value
+        profile_count(options, 'cache misses')
+
+    value = fetch()
+
+    if options.cache is not None and keep(value):
+        options.cache.put(kind, key, value)
+
+    return value
+
+
+class Profiler:
+    """ Records where the time of the builds goes: the time of every stage,
+        the requests to every host, counters such as the cache hits and
+        misses, and the time spent on every DOI. It can be shared by several
+        threads. The stages that run in parallel threads, and the requests,
+        are summed over the threads, so they can add up to more than the wall
+        time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.stages = {} # name -> [seconds, calls]
+        self.hosts = {} # host -> dict of totals
+        self.counters = {}
+        self.DOI_times = {} # DOI -> seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stage = self.stages.setdefault(name, [0.0, 0])
+                stage[0] += elapsed
+                stage[1] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _host(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = {'requests': 0, 'seconds': 0.0, 'bytes': 0,
+                                'errors': 0, 'retries': 0,
+                                'rate_limited_seconds': 0.0}
+        return self.hosts[host]
+
+    def request(self, host, seconds, nbytes, failed, waited=0.0):
+        """ Record one HTTP request. nbytes is the size of the body on the
+            wire, and waited the time spent waiting for the rate limit.
+        """
+        with self.lock:
+            totals = self._host(host)
+            totals['requests'] += 1
+            totals['seconds'] += seconds
+            totals['bytes'] += nbytes
+            totals['errors'] += int(failed)
+            totals['rate_limited_seconds'] += waited
+
+    def retry(self, host):
+        with self.lock:
+            self._host(host)['retries'] += 1
+
+    def add_DOI_time(self, DOI, seconds):
+        with self.lock:
+            self.DOI_times[DOI] = self.DOI_times.get(DOI, 0.0) + seconds
+
+    def report(self, slowest=PROFILE_SLOWEST):
+        """ Everything that has been recorded, as a dict that can be
+            written as JSON.
+        """
+        with self.lock:
+            DOIs = sorted(self.DOI_times.items(), key=lambda item: -item[1])
+            return {'seconds': time.perf_counter() - self.start,
+                    'stages': {name: {'seconds': seconds, 'calls': calls}
+                               for name, (seconds, calls)
+                               in self.stages.items()},
+                    'hosts': {host: dict(totals)
+                              for host, totals in self.hosts.items()},
+                    'counters': dict(self.counters),
+                    'slowest_DOIs': [{'DOI': DOI, 'seconds': seconds}
+                                     for DOI, seconds in DOIs[:slowest]]}
+
+    def table(self, slowest=PROFILE_SLOWEST):
+        """ The report as a text table.
+        """
+        report = self.report(slowest)
+        lines = ['### Profile (' + format(report['seconds'], '.2f') +
+                 ' s in total)', '',
+                 f"{'stage':28s} {'seconds':>10s} {'calls':>8s}"]
+        for name, stage in report['stages'].items():
+            lines.append(f"{name:28s} {stage['seconds']:10.3f} "
+                         f"{stage['calls']:8d}")
+
+        if len(report['hosts']) > 0:
+            lines += ['', f"{'host':28s} {'requests':>8s} {'seconds':>10s} "
+                          f"{'kB':>10s} {'errors':>7s} {'retries':>7s} "
+                          f"{'waited':>8s}"]
+            for host, totals in sorted(report['hosts'].items(),
+                                       key=lambda item: -item[1]['seconds']):
+                lines.append(f"{host:28s} {totals['requests']:8d} "
+                             f"{totals['seconds']:10.3f} "
+                             f"{totals['bytes']/1000:10.1f} "
+                             f"{totals['errors']:7d} {totals['retries']:7d} "
+                             f"{totals['rate_limited_seconds']:8.2f}")
+
+        if len(report['counters']) > 0:
+            lines += ['', f"{'counter':28s} {'value':>10s}"]
+            for name, value in sorted(report['counters'].items()):
+                lines.append(f"{name:28s} {value:10d}")
+
+        if len(report['slowest_DOIs']) > 0:
+            lines += ['', f"{'slowest DOIs':50s} {'seconds':>10s}"]
+            for item in report['slowest_DOIs']:
+                lines.append(f"{item['DOI']:50s} {item['seconds']:10.3f}")
+
+        return '\n'.join(lines)
+
+
+def profile_stage(options, name):
+    """ Time the block as the stage name if the build is profiled, e.g.
+
+            with profile_stage(options, 'labels'):
+                ...
+    """
+    if options.profile is None:
+        return contextlib.nullcontext()
+    return options.profile.stage(name)
+
+
+def profile_count(options, name, n=1):
+    if options.profile is not None:
+        options.profile.count(name, n)
+
+
+class HTTPError(Exception):
+    """ A download that failed, either because of the network or because the
+        server answered with an error status.
+    """
+
+    def __init__(self, url, message, status=None):
+        Exception.__init__(self, url + ': ' + message)
+        self.url = url
+        self.status = status
+
 
+class HTTPResponse:
+    """
+    """
+
+    def __init__(self, url, status, headers, body, complete=True):
+        self.url = url
+        self.status = status
+        self.headers = headers # lower case names
+        self.body = body
+        self.complete = complete # False if only part of the body was read
+
+    def text(self):
+        return self.body.decode('utf-8', errors='replace')
 
-def abbreviate_journal_names(bibfile):
-    """ From Anton.
+
+class RateLimiter:
+    """ Token bucket that limits the requests sent to one host. The rate is
+        halved every time the host says that it gets too many requests, and
+        grows back slowly with every request that goes through.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.hold_until = 0 # from Retry-After
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline):
+        """ Wait for a token. Returns False if that would take until after
+            the deadline.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                              (now - self.last) * self.rate)
+                self.last = now
+
+                if now >= self.hold_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+
+                wait = max(self.hold_until - now,
+                           (1 - self.tokens) / self.rate)
+
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.rate / 2, self.max_rate / 64)
+            self.tokens = min(self.tokens, 0)
+            if retry_after is not None:
+                self.hold_until = max(self.hold_until,
+                                      time.monotonic() + retry_after)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+def parse_retry_after(value):
+    """ The Retry-After header holds either seconds or a date. Returns the
+        number of seconds, or None.
     """
-    bib = parse_file(bibfile)
+    if value is None:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0, date.timestamp() - time.time())
+
+
+class HTTPClient:
+    """ Small in-process HTTP client shared by all the resolvers. It keeps
+        the connections to every host alive and reuses them, follows
+        redirects, and asks for gzip compressed responses.
+
+        The requests to each host are rate limited, see HOST_RATE_LIMITS.
+        Requests that fail because of the network or a temporary server error
+        are retried with a jittered exponential backoff, or after the time
+        given by Retry-After, until the deadline of the request has passed.
+
+        host_map redirects requests for a host to another base URL, e.g.
+        {'doi.org': 'http://127.0.0.1:8000'}, so that a local stand-in
+        server can replace the real websites.
+
+        If profile is a Profiler, the time, size and outcome of every request
+        are recorded per host.
+    """
+
+    redirect_codes = (301, 302, 303, 307, 308)
+    retry_codes = (429, 500, 502, 503, 504)
+    # the requests that can be sent again without doing the work twice
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, timeout=HTTP_TIMEOUT, max_redirects=10,
+                 max_idle_per_host=16, host_map=None, retries=HTTP_RETRIES,
+                 backoff=HTTP_BACKOFF, deadline=HTTP_DEADLINE,
+                 rate_limits=None, profile=None):
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.max_idle_per_host = max_idle_per_host
+        self.host_map = dict(host_map or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self.rate_limits = dict(HOST_RATE_LIMITS)
+        self.rate_limits.update(rate_limits or {})
+        self.lock = threading.Lock()
+        self.idle = {} # (scheme, host, port) -> idle connections
+        self.limiters = {} # host -> RateLimiter
+        self.profile = profile
+
+    def _limiter(self, url):
+        host = urllib.parse.urlsplit(url).hostname
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = RateLimiter(
+                    *self.rate_limits.get(host, DEFAULT_RATE_LIMIT))
+            return self.limiters[host]
+
+    def _target(self, url):
+        """ Returns (scheme, host, port, path) for the url, after applying
+            the host map.
+        """
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = parts.hostname
+        port = parts.port
+
+        if host in self.host_map:
+            mapped = urllib.parse.urlsplit(self.host_map[host])
+            scheme = mapped.scheme.lower()
+            host = mapped.hostname
+            port = mapped.port
+
+        if port is None:
+            port = 443 if scheme == 'https' else 80
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        return scheme, host, port, path
+
+    def _connect(self, key):
+        """ Returns (connection, reused).
+        """
+        with self.lock:
+            if len(self.idle.get(key, [])) > 0:
+                return self.idle[key].pop(), True
+
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port,
+                                               timeout=self.timeout), False
+        return http.client.HTTPConnection(host, port,
+                                          timeout=self.timeout), False
+
+    def _release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+
+        conn.close()
+
+    def _request_once(self, method, url, headers, body=None, deadline=None,
+                      done=None):
+        scheme, host, port, path = self._target(url)
+        key = (scheme, host, port)
+
+        if scheme not in ('http', 'https'):
+            raise HTTPError(url, 'unsupported URL scheme')
+
+        limiter = self._limiter(url)
+        start = time.perf_counter()
+        if deadline is not None and not limiter.acquire(deadline):
+            raise HTTPError(url, 'deadline exceeded while rate limited')
+        waited = time.perf_counter() - start
+
+        # the Host header always names the original website, so that the
+        # stand-in server can tell the requests apart
+        all_headers = {'Host': urllib.parse.urlsplit(url).netloc,
+                       'User-Agent': USER_AGENT,
+                       'Accept-Encoding': 'gzip',
+                       'Connection': 'keep-alive'}
+        all_headers.update(headers)
+
+        conn, reused = self._connect(key)
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=all_headers)
+            resp = conn.getresponse()
+            if done is None:
+                response_body = resp.read()
+                length = len(response_body)
+                complete = True
+            else:
+                response_body, length, complete = read_partial(resp, done)
+        except zlib.error as e:
+            conn.close()
+            raise HTTPError(url, 'bad gzip data: ' + str(e))
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            if reused:
+                # the server has closed the idle connection in the meantime
+                return self._request_once(method, url, headers, body,
+                                          deadline, done)
+            if self.profile is not None:
+                self.profile.request(urllib.parse.urlsplit(url).hostname,
+                                     time.perf_counter() - start, 0, True,
+                                     waited)
+            raise HTTPError(url, str(e))
+
+        if self.profile is not None:
+            self.profile.request(urllib.parse.urlsplit(url).hostname,
+                                 time.perf_counter() - start,
+                                 length, resp.status >= 400, waited)
+        body = response_body
+
+        # the rest of a partly read body would be in the way of the next
+        # request on the connection
+        if resp.will_close or not complete:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        response_headers = {}
+        for name, value in resp.getheaders():
+            response_headers[name.lower()] = value
+
+        if response_headers.get('content-encoding', '').lower() == 'gzip' \
+           and done is None:
+            try:
+                body = gzip.decompress(body)
+            except (OSError, EOFError) as e:
+                raise HTTPError(url, 'bad gzip data: ' + str(e))
+
+        if resp.status in (429, 503):
+            limiter.throttled(parse_retry_after(
+                                        response_headers.get('retry-after')))
+        elif resp.status < 400:
+            limiter.succeeded()
+
+        return HTTPResponse(url, resp.status, response_headers, body,
+                            complete)
+
+    def request(self, method, url, headers=None, body=None, done=None):
+        """ Send the request, follow the redirects, and retry it if it fails
+            temporarily. Raises HTTPError if the server cannot be reached,
+            but not for error statuses. After the last retry, the error
+            status is returned. POST requests are never retried, since the
+            server may have done the work already.
+
+            If done is given, the body is read a chunk at a time, and the
+            rest of it is dropped as soon as done(body read so far) is True,
+            see read_partial().
+        """
+        deadline = time.monotonic() + self.deadline
+        retries = self.retries if method in self.idempotent_methods else 0
+
+        for attempt in range(retries + 1):
+            error = None
+            try:
+                response = self._follow_redirects(method, url, headers, body,
+                                                  deadline, done)
+            except HTTPError as e:
+                error = e
+                delay = None
+            else:
+                if response.status not in self.retry_codes:
+                    return response
+                delay = parse_retry_after(response.headers.get('retry-after'))
+
+            if delay is None:
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+
+            if attempt == retries or \
+               time.monotonic() + delay > deadline:
+                break
+            if self.profile is not None:
+                self.profile.retry(urllib.parse.urlsplit(url).hostname)
+            time.sleep(delay)
+
+        if error is not None:
+            raise error
+        return response
+
+    def _follow_redirects(self, method, url, headers, body, deadline,
+                          done=None):
+        headers = dict(headers or {})
+
+        for redirect in range(self.max_redirects + 1):
+            response = self._request_once(method, url, headers, body,
+                                          deadline, done)
+
+            if response.status not in self.redirect_codes or \
+               'location' not in response.headers:
+                return response
+
+            url = urllib.parse.urljoin(url, response.headers['location'])
+            if response.status == 303:
+                method = 'GET'
+                body = None
+
+        raise HTTPError(url, 'too many redirects')
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers)
+
+    def post(self, url, body, headers=None):
+        return self.request('POST', url, headers, body)
+
+    def get_text(self, url, headers=None):
+        """ Returns the body of the page, raising HTTPError if the server
+            does not answer with 200 OK.
+        """
+        response = self.get(url, headers)
+        if response.status != 200:
+            raise HTTPError(url, 'HTTP status ' + str(response.status),
+                            response.status)
+
+        return response.text()
+
+    def get_partial(self, url, done, headers=None):
+        """ Like get(), but only reads the body until done(body) is True.
+        """
+        return self.request('GET', url, headers, done=done)
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+
+def read_partial(resp, done, max_bytes=SCRAPE_MAX_BYTES):
+    """ Read the body of the response SCRAPE_CHUNK bytes at a time, until
+        done() is True for what has been read (uncompressed if it is
+        gzipped), or max_bytes have been read. Returns (uncompressed body,
+        number of bytes read, True if all of it has been read).
+    """
+    gzipped = (resp.getheader('Content-Encoding') or '').lower() == 'gzip'
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    text = b''
+    length = 0
+
+    while length < max_bytes:
+        chunk = resp.read(SCRAPE_CHUNK)
+        if chunk == b'':
+            break
+
+        length += len(chunk)
+        text += decompressor.decompress(chunk) if gzipped else chunk
+        if resp.isclosed() or done(text):
+            break
+
+    return text, length, resp.isclosed()
+
+
+def http_client():
+    """ The HTTP client shared by all the resolvers, created on first use.
+    """
+    global HTTP
+
+    with HTTP_LOCK:
+        if HTTP is None:
+            HTTP = HTTPClient()
+        return HTTP
+
+
+def set_http_client(client):
+    """ Replace the shared HTTP client, e.g. by one that talks to a local
+        stand-in server in the tests.
+    """
+    global HTTP
+
+    with HTTP_LOCK:
+        if HTTP is not None and HTTP is not client:
+            HTTP.close()
+        HTTP = client
+
+
+def report_download_error(e):
+    """ Failed downloads are always reported, except for pages that do not
+        exist, which are expected.
+    """
+    if e.status != 404:
+        print('### Download failed: ' + str(e))
+
+
+def normalize_DOI(DOI):
+    """ DOIs are case insensitive, and they may be given as URLs.
+    """
+    DOI = DOI.strip()
+    if DOI.lower().find('doi.org/') > -1:
+        DOI = DOI[DOI.lower().find('doi.org/')+8:]
+    if DOI.lower().startswith('doi:'):
+        DOI = DOI[4:]
+
+    return DOI.strip().lower()
+
+
+JOURNAL_ABBREVIATIONS = None # normalized full name -> abbreviation
+JOURNAL_ABBREVIATIONS_LOCK = threading.Lock()
+# updated version of the file found at:
+# https://abbrv.jabref.org/journals/journal_abbreviations_geology_physics.csv
+ABBREVIATIONS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'journal_abbreviations.csv')
+# the compiled journal abbreviations, see AbbreviationIndex. Every checkout
+# has its own, named after a hash of the path of its ABBREVIATIONS_CSV.
+ABBREVIATIONS_INDEX = os.environ.get('BIB_MAKER_ABBREVIATIONS',
+                        os.path.join(os.path.dirname(CACHE_FILE),
+                                     'journal_abbreviations-%08x.idx' %
+                                     zlib.crc32(ABBREVIATIONS_CSV.encode())))
+ABBREVIATIONS_MAGIC = b'BMJABBR2'
+COMPILE_ABBREVIATIONS = None # CSV files given by --compile-abbreviations
+FUZZY_THRESHOLD = None # None unless --fuzzy
+DEFAULT_FUZZY_THRESHOLD = 0.8
+FUZZY_CANDIDATES = 5000 # most names scored for one journal
+SUBTITLE_PENALTY = 0.75 # factor of the scores of names without subtitle
+JOURNAL_MATCHER = None
+
+# characters that are ignored when comparing journal names
+JOURNAL_PUNCTUATION = str.maketrans(string.punctuation,
+                                    ' ' * len(string.punctuation))
+
+
+def normalize_journal_name(journal):
+    """ Case, punctuation, '&amp;' vs '&' and a leading 'The' do not matter
+        when comparing journal names.
+    """
+    journal = journal.replace('&amp;', '&').replace('\\&', '&')
+    journal = journal.replace('&', ' and ').replace('{', '').replace('}', '')
+    journal = journal.translate(JOURNAL_PUNCTUATION).casefold().split()
+
+    if len(journal) > 1 and journal[0] == 'the':
+        journal = journal[1:]
+
+    return ' '.join(journal)
+
+
+def read_abbreviations(csvfiles):
+    """ Returns a dict from normalized journal name to abbreviation, with
+        the rows of the CSV files (full name, abbreviation). Already
+        abbreviated names map to themselves.
+    """
+    abbreviations = []
+    for file_path in csvfiles:
+        with open(file_path, 'r', newline='', encoding='utf-8') as csvfile:
+            for row in csv.reader(csvfile):
+                # skip bad lines
+                if len(row) < 2 or len(row) > 3:
+                    continue
+                abbreviations.append((row[0], row[1]))
+
+    index = {}
+    for name, abbr in abbreviations:
+        index[normalize_journal_name(abbr)] = abbr
+
+    # full names win over abbreviations that look the same
+    for name, abbr in abbreviations:
+        index[normalize_journal_name(name)] = abbr
 
+    return index
 
-    SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(SCRIPT_DIR, 'journal_abbreviations.csv')
-    # updated version of the file found at:
-    # https://abbrv.jabref.org/journals/journal_abbreviations_geology_physics.csv
-    abbreviations = pandas.read_csv(
-        file_path,
-        on_bad_lines="skip",
-        sep=',',
-        names=["abbr", "o1", "o2"],
-    )
 
+def compile_abbreviations(csvfiles, indexfile):
+    """ Write the journal abbreviations of the CSV files to indexfile, for
+        AbbreviationIndex. ABBREVIATIONS_CSV is always added, last, so that
+        its rows win. Returns the number of names. The file is made of the
+        magic bytes, the length of the header and the header, a JSON list of
+        the CSV files and their modification times, the number of names n,
+        n+1 offsets, and the records 'normalized name\tabbreviation' sorted
+        by name, with all numbers as little-endian 32 bit integers.
+    """
+    csvfiles = [os.path.abspath(csvfile) for csvfile in csvfiles]
+    csvfiles = [csvfile for csvfile in csvfiles
+                if csvfile != ABBREVIATIONS_CSV] + [ABBREVIATIONS_CSV]
+    header = json.dumps([[csvfile, os.path.getmtime(csvfile)]
+                         for csvfile in csvfiles]).encode('utf-8')
+
+    records = sorted((name.encode('utf-8'), abbr.encode('utf-8'))
+                     for name, abbr in read_abbreviations(csvfiles).items())
+
+    offsets = [0]
+    for name, abbr in records:
+        offsets.append(offsets[-1] + len(name) + 1 + len(abbr))
+
+    indexdir = os.path.dirname(indexfile)
+    if indexdir != '':
+        os.makedirs(indexdir, exist_ok=True)
+
+    # written next to the index and moved over it, so that it is never seen
+    # half-written
+    tempfile = indexfile + '.' + str(os.getpid())
+    with open(tempfile, 'wb') as outfile:
+        outfile.write(ABBREVIATIONS_MAGIC)
+        outfile.write(struct.pack('<I', len(header)))
+        outfile.write(header)
+        outfile.write(struct.pack('<I', len(records)))
+        outfile.write(struct.pack('<' + str(len(offsets)) + 'I', *offsets))
+        for name, abbr in records:
+            outfile.write(name + b'\t' + abbr)
+    os.replace(tempfile, indexfile)
+
+    return len(records)
+
+
+class AbbreviationIndex:
+    """ The journal abbreviations written by compile_abbreviations(). The
+        file is memory-mapped and the names are found by binary search, so
+        that neither the time to open it nor the memory used grows with the
+        number of journals. Works like a read-only dict.
+
+        sources is the list of (CSV file, modification time) that it has
+        been compiled from.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as infile:
+            self.data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(ABBREVIATIONS_MAGIC)] != ABBREVIATIONS_MAGIC:
+            self.data.close()
+            raise ValueError(filename + ' is not a journal abbreviation index')
+
+        pos = len(ABBREVIATIONS_MAGIC)
+        length = struct.unpack_from('<I', self.data, pos)[0]
+        self.sources = [tuple(source) for source in
+                        json.loads(self.data[pos+4:pos+4+length])]
+        pos += 4 + length
+
+        self.count = struct.unpack_from('<I', self.data, pos)[0]
+        self.offsets = pos + 4
+        self.records = self.offsets + 4 * (self.count + 1)
+
+    def __len__(self):
+        return self.count
+
+    def stale(self):
+        """ True if one of the CSV files has changed since the index was
+            compiled, or if ABBREVIATIONS_CSV is not one of them. The files
+            that are gone do not count, since the index cannot be compiled
+            with them again.
+        """
+        if ABBREVIATIONS_CSV not in [csvfile for csvfile, mtime
+                                     in self.sources]:
+            return True
+
+        return any(os.path.exists(csvfile) and
+                   os.path.getmtime(csvfile) != mtime
+                   for csvfile, mtime in self.sources)
+
+    def close(self):
+        self.data.close()
+
+    def _record(self, ind):
+        start, end = struct.unpack_from('<2I', self.data,
+                                        self.offsets + 4 * ind)
+        record = self.data[self.records+start:self.records+end]
+        tab = record.find(b'\t')
+        return record[:tab], record[tab+1:]
+
+    def get(self, name, default=None):
+        key = name.encode('utf-8')
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.count:
+            found, abbr = self._record(low)
+            if found == key:
+                return abbr.decode('utf-8')
+
+        return default
+
+    def items(self):
+        for ind in range(self.count):
+            name, abbr = self._record(ind)
+            yield name.decode('utf-8'), abbr.decode('utf-8')
+
+
+def journal_abbreviations():
+    """ The index of the journal abbreviations, opened on first use. The
+        compiled index is used. It is compiled from ABBREVIATIONS_CSV if it
+        is missing, and compiled again from the same CSV files if one of them
+        has changed. If that fails, ABBREVIATIONS_CSV is read into a dict
+        instead.
+    """
+    global JOURNAL_ABBREVIATIONS
+
+    with JOURNAL_ABBREVIATIONS_LOCK:
+        if JOURNAL_ABBREVIATIONS is not None:
+            return JOURNAL_ABBREVIATIONS
+
+        try:
+            JOURNAL_ABBREVIATIONS = open_abbreviation_index()
+        except (OSError, ValueError, struct.error) as e:
+            print('### Could not use the compiled journal abbreviations ' +
+                  ABBREVIATIONS_INDEX + ': ' + str(e))
+            JOURNAL_ABBREVIATIONS = read_abbreviations([ABBREVIATIONS_CSV])
+
+        return JOURNAL_ABBREVIATIONS
+
+
+def open_abbreviation_index():
+    """ Open ABBREVIATIONS_INDEX, compiling it first if needed, see
+        journal_abbreviations().
+    """
+    index = None
+    if os.path.exists(ABBREVIATIONS_INDEX):
+        try:
+            index = AbbreviationIndex(ABBREVIATIONS_INDEX)
+        except (ValueError, struct.error) as e:
+            # e.g. written by an older version
+            print('### ' + str(e) + ', compiling it again from ' +
+                  ABBREVIATIONS_CSV)
+
+    if index is None:
+        compile_abbreviations([], ABBREVIATIONS_INDEX)
+    elif index.stale():
+        csvfiles = []
+        for csvfile, mtime in index.sources:
+            if os.path.exists(csvfile):
+                csvfiles.append(csvfile)
+            else:
+                print('### ' + csvfile + ' is gone, its journals are left '
+                      'out of ' + ABBREVIATIONS_INDEX)
+        index.close()
+
+        print('### Compiling the journal abbreviations again from ' +
+              ', '.join(csvfiles))
+        compile_abbreviations(csvfiles, ABBREVIATIONS_INDEX)
+    else:
+        return index
+
+    return AbbreviationIndex(ABBREVIATIONS_INDEX)
+
+
+class JournalMatcher:
+    """ Finds the name in the abbreviation list that is closest to a
+        journal that is not in it. An inverted index from the words of the
+        names to the names that contain them is built once, and only the
+        names that share the rarest words of the journal are scored, so that
+        a lookup does not go through the whole list. The score is the Dice
+        similarity of the character trigrams of the names, and the single
+        letters and numbers (e.g. Physical Review A and B) must be the same.
+
+        The matches that are made are kept in matches, a dict from journal to
+        (abbreviation, score, matched name), to be reported.
+    """
+
+    def __init__(self, abbreviations):
+        self.abbreviations = abbreviations
+        self.names = []
+        self.postings = {} # word -> numbers of the names with that word
+        for name, abbr in abbreviations.items():
+            for word in set(name.split()):
+                self.postings.setdefault(word, []).append(len(self.names))
+            self.names.append(name)
+
+        self.lock = threading.Lock()
+        self.matches = {}
+        self.seen = {} # (journal, threshold) -> abbreviation or None
+
+    def match(self, journal, threshold):
+        """ Returns the abbreviation of the closest name, or None if no
+            name is at least as close as the threshold.
+        """
+        with self.lock:
+            if (journal, threshold) in self.seen:
+                return self.seen[journal, threshold]
+
+        abbr = None
+        best = self._best(journal)
+        if best is not None and best[1] >= threshold:
+            abbr = self.abbreviations.get(best[0])
+
+        with self.lock:
+            self.seen[journal, threshold] = abbr
+            if abbr is not None:
+                self.matches[journal] = (abbr, best[1], best[0])
+
+        return abbr
+
+    def _best(self, journal):
+        """ (name, score) of the closest name, or None.
+        """
+        name = normalize_journal_name(journal)
+        markers = name_markers(name)
+        best = self._closest(name, markers, 1.0)
+
+        # subtitles, e.g. Physical Review B: Condensed Matter, are also tried
+        # without the subtitle, with a penalty, since the name without it may
+        # be another journal. The letters and numbers of the subtitle must
+        # still match, e.g. Advances in Physics: X is not Advances in Physics.
+        if journal.find(':') > -1:
+            title = normalize_journal_name(journal[:journal.find(':')])
+            stripped = self._closest(title, markers, SUBTITLE_PENALTY)
+            if stripped is not None and \
+               (best is None or stripped[1] > best[1]):
+                best = stripped
+
+        return best
+
+    def _closest(self, name, markers, weight):
+        """ (name, score times weight) of the closest name with the given
+            markers, or None.
+        """
+        words = sorted((word for word in set(name.split())
+                        if word in self.postings),
+                       key=lambda word: len(self.postings[word]))
+
+        candidates = set()
+        for word in words[:2]:
+            candidates.update(self.postings[word][:FUZZY_CANDIDATES])
+
+        best = None
+        trigrams = name_trigrams(name)
+        for ind in candidates:
+            other = self.names[ind]
+            if name_markers(other) != markers:
+                continue
+
+            other_trigrams = name_trigrams(other)
+            score = weight * 2 * len(trigrams & other_trigrams) / \
+                    (len(trigrams) + len(other_trigrams))
+            if best is None or score > best[1]:
+                best = (other, score)
+
+        return best
+
+
+def name_trigrams(name):
+    name = ' ' + name + ' '
+    return set(name[ind:ind+3] for ind in range(len(name) - 2))
+
+
+def name_markers(name):
+    """ The words that tell journals with otherwise equal names apart.
+    """
+    return set(word for word in name.split()
+               if len(word) == 1 or any(char.isdigit() for char in word))
+
+
+def journal_matcher():
+    """ The JournalMatcher of the abbreviation list, built on first use.
+    """
+    global JOURNAL_MATCHER
+
+    abbreviations = journal_abbreviations()
+    with JOURNAL_ABBREVIATIONS_LOCK:
+        if JOURNAL_MATCHER is None:
+            JOURNAL_MATCHER = JournalMatcher(abbreviations)
+        return JOURNAL_MATCHER
+
+
+def report_fuzzy_matches():
+    """ Print the journals that have been matched approximately, as rows
+        for journal_abbreviations.csv.
+    """
+    if JOURNAL_MATCHER is None or len(JOURNAL_MATCHER.matches) == 0:
+        return
+
+    print('### Journals matched approximately (check them, and add them to '
+          'journal_abbreviations.csv):')
+    for journal, (abbr, score, name) in sorted(
+                                        JOURNAL_MATCHER.matches.items()):
+        print('"' + journal + '","' + abbr + '"' + ' ' * 4 +
+              f"# {score:.2f} {name}")
+
+
+def abbreviate_journal_name(journal, options):
+    """ Returns the abbreviation of the journal, or the journal itself if
+        it is not in the list.
+    """
+    abbr = journal_abbreviations().get(normalize_journal_name(journal))
+    if abbr is not None:
+        return abbr
+
+    if options.fuzzy is not None and journal.lower().find('arxiv') == -1:
+        abbr = journal_matcher().match(journal, options.fuzzy)
+        if abbr is not None:
+            return abbr
+
+    # ignore arXiv when listing not found abbreviations
+    if journal.lower().find('arxiv') == -1 and options.verbose:
+        print(f"{journal} not in list")
+
+    return journal
+
+
+def abbreviate_journal_names(bib, options):
+    """ From Anton. Replaces the journal names of the BibliographyData by
+        their abbreviations, in place.
+    """
     for item in bib.entries.values():
-        if "journal" not in item.fields:
+        if "journal" in item.fields:
+            item.fields["journal"] = abbreviate_journal_name(
+                                            item.fields["journal"], options)
+
+
+# new style (2101.00001v2) and old style (hep-th/9901001, math.AG/0101001)
+# arXiv identifiers
+ARXIV_ID_RE = re.compile(r'(\d{4}\.\d{4,5})(?:v\d+)?|'
+                         r'([a-z]+(?:-[a-z]+)*(?:\.[A-Z]{2})?/\d{7})(?:v\d+)?')
+
+ARXIV_API = 'http://export.arxiv.org/api/query'
+ARXIV_BATCH_SIZE = 100
+ATOM_NS = {'atom': 'http://www.w3.org/2005/Atom',
+           'arxiv': 'http://arxiv.org/schemas/atom'}
+
+
+def get_arXiv_id(b2):
+    """ Returns the arXiv identifier found in the string, without the
+        version number, or None.
+    """
+    match = ARXIV_ID_RE.search(b2)
+    if match is None:
+        return None
+
+    return match.group(1) or match.group(2)
+
+
+def get_DOI_from_arXiv(b2, options):
+    """
+    """
+    arXiv_id = get_arXiv_id(b2)
+    if arXiv_id is None:
+        return 'DOI_NOT_FOUND'
+
+    return get_DOIs_from_arXiv([arXiv_id], options)[arXiv_id]
+
+
+def get_DOIs_from_arXiv(arXiv_ids, options, slots=None):
+    """ Returns a dict from arXiv identifier to DOI. Published papers get the
+        DOI of the journal, the others the DOI assigned by arXiv. The
+        identifiers that are not in the cache are looked up in bulk, with
+        ARXIV_BATCH_SIZE of them per query. slots is a semaphore that every
+        query holds while it runs, e.g. the slots of a Prefetcher that is
+        still downloading, so that both stay within options.jobs.
+    """
+    DOIs = {}
+    missing = []
+
+    for arXiv_id in dict.fromkeys(arXiv_ids):
+        DOI = CACHE_MISS
+        if options.cache is not None and not options.refresh:
+            DOI = options.cache.get('arxiv_doi', arXiv_id)
+
+        if DOI is CACHE_MISS:
+            missing.append(arXiv_id)
+        else:
+            DOIs[arXiv_id] = DOI
+
+    if options.cache is not None and not options.refresh:
+        profile_count(options, 'cache hits', len(DOIs))
+        profile_count(options, 'cache misses', len(missing))
+
+    batches = [missing[i:i+ARXIV_BATCH_SIZE]
+               for i in range(0, len(missing), ARXIV_BATCH_SIZE)]
+
+    if slots is None:
+        slots = contextlib.nullcontext()
+
+    def lookup(batch):
+        with slots:
+            return fetch_DOIs_from_arXiv(batch, options)
+
+    if len(batches) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, min(options.jobs,
+                                                       len(batches)))) as pool:
+            for batch, found in zip(batches, pool.map(lookup, batches)):
+                for arXiv_id in batch:
+                    # None means that the query itself failed
+                    if found is None:
+                        DOIs[arXiv_id] = 'DOI_NOT_FOUND'
+                        continue
+
+                    DOIs[arXiv_id] = found.get(arXiv_id, 'DOI_NOT_FOUND')
+                    if options.cache is not None and arXiv_id in found:
+                        options.cache.put('arxiv_doi', arXiv_id,
+                                          DOIs[arXiv_id])
+
+    return DOIs
+
+
+def fetch_DOIs_from_arXiv(arXiv_ids, options):
+    """ Ask the arXiv API about all the identifiers in a single query, and
+        return a dict from identifier to DOI. Identifiers that arXiv does not
+        know are left out. Returns None if the query failed.
+    """
+    query = urllib.parse.urlencode({'id_list': ','.join(arXiv_ids),
+                                    'max_results': len(arXiv_ids)})
+    try:
+        atom = http_client().get_text(ARXIV_API + '?' + query)
+        feed = xml.etree.ElementTree.fromstring(atom)
+    except (HTTPError, xml.etree.ElementTree.ParseError) as e:
+        print('### arXiv query failed: ' + str(e))
+        return None
+
+    DOIs = {}
+    for entry in feed.findall('atom:entry', ATOM_NS):
+        # e.g. http://arxiv.org/abs/hep-th/9901001v1
+        abs_url = entry.findtext('atom:id', '', ATOM_NS)
+        if abs_url.find('/abs/') == -1:
+            continue # arXiv reports unknown identifiers as errors
+
+        arXiv_id = get_arXiv_id(abs_url[abs_url.find('/abs/')+5:])
+        if arXiv_id is None:
             continue
 
-        found_abbreviation = False
-        for ind in abbreviations.index:
-            if item.fields["journal"].lower() == \
-               abbreviations.abbr.values[ind].lower():
-                item.fields["journal"] = abbreviations.o1.values[ind]
+        DOI = entry.findtext('arxiv:doi', '', ATOM_NS).split()
+        if len(DOI) > 0:
+            DOI = DOI[0]
+        else:
+            DOI = '10.48550/arXiv.' + arXiv_id
 
-                found_abbreviation = True
+        DOIs[arXiv_id] = DOI
 
-        # ignore arXiv when listing not found abbreviations
-        if item.fields["journal"].lower().find('arxiv') > -1:
-            found_abbreviation = True 
+    return DOIs
 
-        if not found_abbreviation and VERBOSE:
-            print(f"{item.fields['journal']} not in list")
 
-    bib.to_file(bibfile)
+# what is scraped from the journal pages
+CITATION_DOI_RE = re.compile(rb'<meta name="citation_doi" content="([^"]*)"')
+ARTICLE_NUMBER_RE = re.compile(rb'"article-number">([^<]*)<')
+HEAD_END_RE = re.compile(rb'</head\s*>', re.IGNORECASE)
 
 
-def get_DOI_from_arXiv(b2):
+def publisher_slot(url):
+    """ The semaphore that limits the number of pages of a publisher that
+        are scraped at the same time. The publisher is the website, or the
+        DOI prefix for the pages reached through doi.org.
     """
+    parts = urllib.parse.urlsplit(url)
+    publisher = parts.hostname
+    if publisher in ('doi.org', 'dx.doi.org'):
+        publisher = parts.path.lstrip('/').split('/')[0]
+
+    with PUBLISHER_SLOTS_LOCK:
+        if publisher not in PUBLISHER_SLOTS:
+            PUBLISHER_SLOTS[publisher] = \
+                        threading.BoundedSemaphore(PUBLISHER_CONNECTIONS)
+        return PUBLISHER_SLOTS[publisher]
+
+
+def scrape_page(url, pattern, headers=None, head_only=False):
+    """ Returns the first group of the first match of pattern (a bytes
+        regular expression) in the page, or None. The page is only downloaded
+        until the match, or the end of its head if head_only is set, and at
+        most SCRAPE_MAX_BYTES of it. Raises HTTPError if it cannot be
+        downloaded.
     """
-    DOI = 'DOI_NOT_FOUND'
+    def done(text):
+        return pattern.search(text) is not None or \
+               (head_only and HEAD_END_RE.search(text) is not None)
 
-    arXiv_numbers = re.findall(r'\d+', b2)
-    try: # old arXiv papers have only one number, need to implement
-        page = urlopen('https://arxiv.org/abs/' + 
-                        arXiv_numbers[0] + '.' + 
-                        arXiv_numbers[1])
-        html_bytes = page.read()
-        html = html_bytes.decode("utf-8")
-        if html.find('data-doi="') > -1:
-            html = html[html.find('data-doi="')+10:]
-            DOI = html[:html.find('"')]
-
-        elif html.find('id="arxiv-doi-link">') > -1:
-            html = html[html.find('id="arxiv-doi-link">')+20:]
-            DOI = html[:html.find('<')]
-    except:
-        pass
-    
-    return DOI
+    with publisher_slot(url):
+        response = http_client().get_partial(url, done, headers)
+
+    if response.status != 200:
+        raise HTTPError(url, 'HTTP status ' + str(response.status),
+                        response.status)
+
+    match = pattern.search(response.body)
+    if match is None:
+        return None
+    return match.group(1).decode('utf-8', errors='replace')
+
+
+def get_DOI_from_journal_page(url, site_type, options):
+    """
+    """
+    return cached('page_doi', url,
+                  lambda: fetch_DOI_from_journal_page(url, site_type),
+                  options, keep=lambda DOI: DOI != 'DOI_NOT_FOUND')
 
 
-def get_DOI_using_lynx(url, site_type):
+def fetch_DOI_from_journal_page(url, site_type):
     """
     """
     sites_type_1 = ['sciencedirect.com',
                     ]
 
     if site_type in sites_type_1:
-        os.system('lynx --source "' + url +
-                  '" > temppage.html')
-
-        journalsite = open('temppage.html', 'r')
-        ft = ""
-        for myline in journalsite.readlines():
-            ft += myline
-
-        journalsite.close()
-        os.system('rm temppage.html')
+        try:
+            DOI = scrape_page(url, CITATION_DOI_RE, BROWSER_HEADERS,
+                              head_only=True)
+        except HTTPError as e:
+            report_download_error(e)
+            return 'DOI_NOT_FOUND'
 
-        if ft.find('<meta name="citation_doi" content="') > -1:
-            ft = ft[ft.find('<meta name="citation_doi" content="')+35:]
-            DOI = ft[:ft.find('"')]
+        if DOI is not None:
             return DOI
 
     return 'DOI_NOT_FOUND'
 
 
 # NOT USED ANYMORE
-def get_pages_using_lynx(url, journal):
+def get_pages_from_journal_page(url, journal):
     """
     """
     journals_type_1 = ['Applied Physics Letters',
@@ -238,11 +1736,7 @@ def get_pages_using_lynx(url, journal):
                       ]
 
     if journal in journals_type_1:
-        s = subprocess.run(['lynx', '--source', url], 
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
-                           text=True, check=True)
-
-        ft = s.stdout
+        ft = http_client().get_text(url, BROWSER_HEADERS)
 
         if ft.find('"pageStart":"') > -1:
             ft = ft[ft.find('"pageStart":"')+13:]
@@ -255,11 +1749,7 @@ def get_pages_using_lynx(url, journal):
 
 
     if journal in journals_type_2:
-        s = subprocess.run(['lynx', '--source', url], 
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
-                           text=True, check=True)
-
-        ft = s.stdout
+        ft = http_client().get_text(url, BROWSER_HEADERS)
 
         if ft.find('<meta name="dc.Identifier" scheme="publisher-id" content="') > -1:
             ft = ft[ft.find('<meta name="dc.Identifier" scheme="publisher-id" content="')+58:]
@@ -272,225 +1762,409 @@ def get_pages_using_lynx(url, journal):
     return None
 
 
-def get_pages_using_crossref(url, journal):
+def get_pages_using_crossref(DOI, options):
+    """ The article number, or else the first page, registered with crossref.
     """
+    work = get_crossref_works([DOI], options).get(normalize_DOI(DOI))
+    if work is None:
+        return None
+
+    return pages_from_crossref(work)
+
+
+def get_article_number(DOI, options):
+    """ Scrape the article number from the journal website.
     """
+    return cached('article_number', normalize_DOI(DOI),
+                  lambda: fetch_article_number(DOI),
+                  options, keep=lambda pages: pages is not None)
 
-    # lazy way
-    # os.system('curl -L -iH "Accept: application/vnd.crossref.unixsd+xml" ' +
-              # url + ' > temp.temp')
-    # myfile = open('temp.temp', 'r')
 
-    # for myline in myfile.readlines():
-        # if(myline.find('"article_number">') > -1):
-            # pages = myline[myline.find('"article_number">')+17:]
-            # pages = pages[:pages.find('<')]
-            # return pages
+def fetch_article_number(DOI):
+    """
+    """
+    try:
+        return scrape_page('https://doi.org/' + DOI, ARTICLE_NUMBER_RE)
+    except HTTPError as e:
+        report_download_error(e)
+        return None
 
 
-    # smarter way?
-    result = subprocess.run(
-        ["curl", "-s", "-L", "-iH", 
-         "Accept: application/vnd.crossref.unixsd+xml", url],
-         stdout=subprocess.PIPE,
-         stderr=subprocess.PIPE,
-         check=True,
-         text=True
-        )
+# marks the DOIs that still have to be looked up on arXiv
+ARXIV_PENDING = 'ARXIV_PENDING:'
 
-    if result.stdout.find('"article_number">') > -1:
-        pages = result.stdout[result.stdout.find('"article_number">')+17:]
-        pages = pages[:pages.find('<')]
-        return pages
 
-    if result.stdout.find('"article-number">') > -1:
-        pages = result.stdout[result.stdout.find('"article-number">')+17:]
-        pages = pages[:pages.find('<')]
-        return pages
+def defer_arXiv(b2):
+    """ The arXiv identifiers are resolved in bulk once the whole bbl file
+        has been read, so only remember the identifier for now.
+    """
+    arXiv_id = get_arXiv_id(b2)
+    if arXiv_id is None:
+        return 'DOI_NOT_FOUND'
 
-    if result.stdout.find('"citation_firstpage" content="') > -1:
-        pages = result.stdout[result.stdout.find('"citation_firstpage" content="')+30:]
-        pages = pages[:pages.find('"')]
-        return pages
+    return ARXIV_PENDING + arXiv_id
 
-    return None
+
+# marks the DOIs that still have to be scraped from a journal page, followed
+# by the site, the URL and the DOI to use if the page has none
+PAGE_DOI_PENDING = 'PAGE_DOI_PENDING:'
 
 
-def extract_input_from_bbl(bblfilename, 
-                           outfilename='temp.txt'):
+def defer_page_DOI(url, site_type):
+    """ The journal pages are scraped in parallel once the whole bbl file
+        has been read, so only remember the page for now.
     """
+    return PAGE_DOI_PENDING + site_type + ' ' + url
+
+
+def get_DOIs_from_journal_pages(pending, options, slots=None):
+    """ Returns a dict from the PAGE_DOI_PENDING placeholders to the DOIs
+        found on their journal pages, or their fallback DOIs. The pages are
+        scraped by options.jobs workers, each holding one of the slots (a
+        semaphore) if given.
     """
-    if VERBOSE:
-        print('### Extracting labels and DOIs from bbl file')
-        print()
+    if slots is None:
+        slots = contextlib.nullcontext()
 
-    infile = open(bblfilename, 'r')
+    def scrape(placeholder):
+        site_type, page = placeholder[len(PAGE_DOI_PENDING):].split(' ', 1)
+        url, fallback = page.rsplit(' ', 1)
+        with slots:
+            DOI = get_DOI_from_journal_page(url, site_type, options)
 
-    all_labels = []
-    all_DOIs = []
+        if DOI == 'DOI_NOT_FOUND':
+            return fallback
+        return DOI
 
-    # put everything into one row
-    fulltext = ''
-    for myline in infile.readlines():
-        fulltext += myline
+    pending = list(dict.fromkeys(pending))
+    if len(pending) == 0:
+        return {}
 
+    with ThreadPoolExecutor(max_workers=max(1, min(options.jobs,
+                                                   len(pending)))) as pool:
+        return dict(zip(pending, pool.map(scrape, pending)))
 
-    infile.close()
 
-    finished = False
-    while not finished:
+# \bibitem, but not \bibitemStop etc. from the preamble of revtex bbl files
+BIBITEM_RE = re.compile(r'\\bibitem(?![A-Za-z@])|'
+                        r'\\end\s*\{thebibliography\}')
 
-        if fulltext.find("\\bibitem") == -1: # no more entries
-            finished = True
-            continue
 
-        fulltext = fulltext[fulltext.find("\\bibitem"):]
-        fulltext = fulltext[fulltext.find("]")+2:]
+def iter_bibitems(infile):
+    """ Read the bbl file line by line, and yield (label, bibitem) for every
+        entry as soon as it is complete, so that only one entry is kept in
+        memory at a time. Works for revtex bbl files, where the bibitem is
+        the text between \BibitemOpen and \BibitemShut, and for plain ones,
+        where it runs until the next \bibitem.
+    """
+    chunk = None # the lines of the current entry
+
+    for myline in infile:
+        pos = 0
+        for match in BIBITEM_RE.finditer(myline):
+            if chunk is not None:
+                chunk.append(myline[pos:match.start()])
+                record = parse_bibitem(''.join(chunk))
+                if record is not None:
+                    yield record
+
+            pos = match.start()
+            if match.group().startswith('\\bibitem'):
+                chunk = []
+            else: # end of the bibliography
+                chunk = None
+
+        if chunk is not None:
+            chunk.append(myline[pos:])
+
+    if chunk is not None:
+        record = parse_bibitem(''.join(chunk))
+        if record is not None:
+            yield record
+
+
+def parse_bibitem(text):
+    """ Split the text of one entry, starting with \bibitem, into its label
+        and the rest. Returns None if there is no proper label.
+    """
+    ind = len('\\bibitem')
+    while ind < len(text) and text[ind].isspace():
+        ind += 1
 
-        label = fulltext[:fulltext.find("}")].strip()
+    # skip the optional argument, which may contain braces and brackets
+    if ind < len(text) and text[ind] == '[':
+        depth = 0
+        for ind in range(ind, len(text)):
+            if text[ind] == '{':
+                depth += 1
+            elif text[ind] == '}':
+                depth -= 1
+            elif text[ind] == ']' and depth == 0:
+                break
+        ind += 1
 
-        if len(label) < 1 or label.find("\\") > -1: # still in preamble
-            continue
+        while ind < len(text) and text[ind].isspace():
+            ind += 1
 
-        all_labels.append(label)
+    if ind >= len(text) or text[ind] != '{' or text.find('}', ind) == -1:
+        return None
 
-        fulltext = fulltext[fulltext.find("\\BibitemOpen"):]
+    label = text[ind+1:text.find('}', ind)].strip()
 
-        bibitem = fulltext[:fulltext.find("\\BibitemShut")]
+    if len(label) < 1 or label.find("\\") > -1: # still in preamble
+        return None
 
-        DOI = 'DOI_NOT_FOUND'
+    bibitem = text[text.find('}', ind)+1:]
+    if bibitem.find("\\BibitemOpen") > -1:
+        bibitem = bibitem[bibitem.find("\\BibitemOpen"):]
+    if bibitem.find("\\BibitemShut") > -1:
+        bibitem = bibitem[:bibitem.find("\\BibitemShut")]
+
+    return label, bibitem
+
+
+def find_DOI_in_bibitem(bibitem, options):
+    """ Returns the DOI of a bbl entry, 'DOI_NOT_FOUND', or a placeholder for
+        an arXiv identifier or a journal page that still has to be resolved.
+    """
+    DOI = 'DOI_NOT_FOUND'
 
-        # check if DOI is explicitly listed
-        if bibitem.find("\\doibase") > -1:
-            bibitem = bibitem[bibitem.find("\\doibase")+8:]
-            DOI = bibitem[:bibitem.find("}")].strip()
+    # check if DOI is explicitly listed
+    if bibitem.find("\\doibase") > -1:
+        bibitem = bibitem[bibitem.find("\\doibase")+8:]
+        DOI = bibitem[:bibitem.find("}")].strip()
+
+        if DOI.lower().find('arxiv') > -1:
+            DOI = DOI[DOI.lower().find('arxiv'):]
+            DOI = defer_arXiv(DOI)
+
+    # try to find the DOI from the URL
+    elif bibitem.find("\\href") > -1:
+        b2 = bibitem[bibitem.find("\\href")+5:]
+        b2 = b2[:b2.find("}")]
+        # maybe the URL contains the DOI in it
+        if b2.find("doi.org/") > -1:
+            b2 = b2[b2.find("doi.org/")+8:]
+            DOI = b2.strip()
 
             if DOI.lower().find('arxiv') > -1:
                 DOI = DOI[DOI.lower().find('arxiv'):]
-                DOI = get_DOI_from_arXiv(b2)
-
-        # try to find the DOI from the URL
-        elif bibitem.find("\\href") > -1:
-            b2 = bibitem[bibitem.find("\\href")+5:]
-            b2 = b2[:b2.find("}")]
-            # maybe the URL contains the DOI in it
-            if b2.find("doi.org/") > -1:
-                b2 = b2[b2.find("doi.org/")+8:]
-                DOI = b2.strip()
-
-                if DOI.lower().find('arxiv') > -1:
-                    DOI = DOI[DOI.lower().find('arxiv'):]
-                    DOI = get_DOI_from_arXiv(DOI)
-
-
-            elif b2.find("/10.") > -1 and b2[b2.find("/10.")+8] == "/":
-                b2 = b2[b2.find("/10.")+1:]
-                if b2.rfind('/meta') > -1:
-                    b2 = b2[:b2.rfind('/meta')]
-
-                DOI = b2.strip()
-
-                if DOI.lower().find('arxiv') > -1:
-                    DOI = DOI[DOI.lower().find('arxiv'):]
-                    DOI = get_DOI_from_arXiv(b2)
-
-
-                # trim extra bits after the DOI in the URL
-                if DOI.rfind("&") > -1:
-                    DOI = DOI[:DOI.rfind("&")]
-                if DOI.rfind("?") > -1:
-                    DOI = DOI[:DOI.rfind("?")]
-
-            # if there's an arXiv URL, scrape the website for the DOI
-            # and if it's been already published then use the published DOI
-            elif b2.find('arxiv.org/') > -1:
-                b2 = b2[b2.find('arxiv.org/'):]
-                DOI = get_DOI_from_arXiv(b2)
-
-            # if it's a URL from nature.com, extract the DOI from it
-            elif b2.find('www.nature.com/articles/') > -1:
-                b2 = b2[b2.find('www.nature.com/articles/')+24:]
-
-                if b2[-4:] == '.pdf':
-                    b2 = b2[:-4]
-                if b2.rfind('&') > -1:
-                    b2 = b2[:b2.rfind('&')]
-                if b2.rfind('?') > -1:
-                    b2 = b2[:b2.rfind('?')]
-
-                DOI = '10.1038/' + b2
-
-            elif b2.find('sciencedirect.com') > -1:
-                if EXPERIMENTAL:
-                    if b2.find('{') > -1:
-                        b2 = b2[b2.find('{')+1:]
-
-                    DOI = get_DOI_using_lynx(b2.strip(), 'sciencedirect.com')
-
-        # DOI not found using href, but there is an Eprint
-        if DOI == 'DOI_NOT_FOUND' and bibitem.find("\\Eprint") > -1:
-            b2 = bibitem[bibitem.find("\\Eprint")+7:]
-            b2 = b2[:b2.find("}")]
-            DOI = get_DOI_from_arXiv(b2)
-
-        # DOI not found using href or Eprint, but maybe arXiv in journal name
-        if DOI == 'DOI_NOT_FOUND' and bibitem.find("{journal}") > -1:
-            b2 = bibitem[bibitem.rfind("{journal}")+9:]
-            b2 = b2[:b2.find("}")]
-
-            if b2.lower().find('arxiv:') > -1:
-                b2 = b2[b2.lower().find('arxiv:'):]
-                DOI = get_DOI_from_arXiv(b2)
-
-        all_DOIs.append(DOI)
-        
-        if VERBOSE:
-            print(label, DOI)
+                DOI = defer_arXiv(DOI)
+
+
+        elif b2.find("/10.") > -1 and b2[b2.find("/10.")+8] == "/":
+            b2 = b2[b2.find("/10.")+1:]
+            if b2.rfind('/meta') > -1:
+                b2 = b2[:b2.rfind('/meta')]
+
+            DOI = b2.strip()
+
+            if DOI.lower().find('arxiv') > -1:
+                DOI = DOI[DOI.lower().find('arxiv'):]
+                DOI = defer_arXiv(b2)
+
+
+            # trim extra bits after the DOI in the URL
+            if DOI.rfind("&") > -1:
+                DOI = DOI[:DOI.rfind("&")]
+            if DOI.rfind("?") > -1:
+                DOI = DOI[:DOI.rfind("?")]
+
+        # if there's an arXiv URL, ask arXiv for the DOI, and if it's
+        # been already published then use the published DOI
+        elif b2.find('arxiv.org/') > -1:
+            b2 = b2[b2.find('arxiv.org/'):]
+            DOI = defer_arXiv(b2)
+
+        # if it's a URL from nature.com, extract the DOI from it
+        elif b2.find('www.nature.com/articles/') > -1:
+            b2 = b2[b2.find('www.nature.com/articles/')+24:]
 
+            if b2[-4:] == '.pdf':
+                b2 = b2[:-4]
+            if b2.rfind('&') > -1:
+                b2 = b2[:b2.rfind('&')]
+            if b2.rfind('?') > -1:
+                b2 = b2[:b2.rfind('?')]
 
-    outfile = open(outfilename, 'w')
-    for ind in range(len(all_labels)):
-        print(all_labels[ind], all_DOIs[ind], file=outfile)
+            DOI = '10.1038/' + b2
 
-    outfile.close()
+        elif b2.find('sciencedirect.com') > -1:
+            if options.experimental:
+                if b2.find('{') > -1:
+                    b2 = b2[b2.find('{')+1:]
 
-    if ("DOI_NOT_FOUND" in all_DOIs) and (FORCE == False):
-        rtfm("couldn't find all DOIs. Input file needs manual cleanup.")
+                DOI = defer_page_DOI(b2.strip(), 'sciencedirect.com')
+
+    # the page is scraped later, the rest is the fallback if it has no DOI
+    page = None
+    if DOI.startswith(PAGE_DOI_PENDING):
+        page = DOI
+        DOI = 'DOI_NOT_FOUND'
+
+    # DOI not found using href, but there is an Eprint
+    if DOI == 'DOI_NOT_FOUND' and bibitem.find("\\Eprint") > -1:
+        b2 = bibitem[bibitem.find("\\Eprint")+7:]
+        b2 = b2[:b2.find("}")]
+        DOI = defer_arXiv(b2)
+
+    # DOI not found using href or Eprint, but maybe arXiv in journal name
+    if DOI == 'DOI_NOT_FOUND' and bibitem.find("{journal}") > -1:
+        b2 = bibitem[bibitem.rfind("{journal}")+9:]
+        b2 = b2[:b2.find("}")]
+
+        if b2.lower().find('arxiv:') > -1:
+            b2 = b2[b2.lower().find('arxiv:'):]
+            DOI = defer_arXiv(b2)
+
+    if page is not None:
+        return page + ' ' + DOI
+
+    return DOI
 
 
-def process_bibfile():
+def extract_input_from_bbl(bblfile, options, outfilename=None,
+                           prefetch=None):
+    """ Returns the (label, DOI) pairs of the entries in the bbl file.
+        Raises BibMakerError if some DOIs were not found, unless
+        options.force is set, in which case those entries are left out. In
+        that case all the pairs are written to outfilename, if given, in the
+        format of the input files, for manual cleanup. bblfile is a file name
+        or an open file.
+
+        If prefetch is a Prefetcher, every DOI is handed to it as soon as it
+        is found, so that it is downloaded while the rest of the file is
+        being read.
     """
+    all_labels, all_DOIs = read_bbl_entries(bblfile, options, prefetch)
+
+    # look up all the arXiv identifiers at once, while the prefetched
+    # downloads go on
+    slots = None
+    if prefetch is not None:
+        slots = prefetch.slots
+    with profile_stage(options, 'arXiv lookup'):
+        arXiv_DOIs = get_DOIs_from_arXiv(pending_arXiv_ids(all_DOIs), options,
+                                         slots)
+
+    return resolve_bbl_entries(all_labels, all_DOIs, arXiv_DOIs, options,
+                               outfilename, prefetch)
+
+
+def read_bbl_entries(bblfile, options, prefetch=None):
+    """ The first half of extract_input_from_bbl(): returns the labels and
+        the DOIs of the entries of the bbl file, where the DOIs that still
+        have to be looked up on arXiv are marked with ARXIV_PENDING, and
+        those on journal pages with PAGE_DOI_PENDING.
     """
+    if isinstance(bblfile, str):
+        with open(bblfile, 'r') as infile:
+            return read_bbl_entries(infile, options, prefetch)
 
-    if VERBOSE:
-        print('### Processing input file')
+    if options.verbose:
+        print('### Extracting labels and DOIs from bbl file')
         print()
 
-    myfile = open(INPUT_FILE, 'r')
+    all_labels = []
+    all_DOIs = []
+
+    with profile_stage(options, 'bbl parsing'):
+        for label, bibitem in iter_bibitems(bblfile):
+            all_labels.append(label)
+            all_DOIs.append(find_DOI_in_bibitem(bibitem, options))
 
-    if OVERWRITE:
-        outfile = open(BIB_FILE, 'w')
-    else:
-        outfile = open(BIB_FILE, 'a')
+            if prefetch is not None and all_DOIs[-1] != 'DOI_NOT_FOUND' and \
+               not all_DOIs[-1].startswith(ARXIV_PENDING) and \
+               not all_DOIs[-1].startswith(PAGE_DOI_PENDING):
+                prefetch.add(all_DOIs[-1])
 
-    all_labels = []
+    return all_labels, all_DOIs
 
-    missing_pages = []
 
-    for myline in myfile.readlines():
+def pending_arXiv_ids(all_DOIs):
+    """ The arXiv identifiers marked with ARXIV_PENDING, also those that are
+        the fallback of a journal page, since they are looked up in bulk.
+    """
+    return [DOI[DOI.find(ARXIV_PENDING)+len(ARXIV_PENDING):]
+            for DOI in all_DOIs if DOI.find(ARXIV_PENDING) > -1]
+
+
+def resolve_bbl_entries(all_labels, all_DOIs, arXiv_DOIs, options,
+                        outfilename=None, prefetch=None):
+    """ The second half of extract_input_from_bbl(): scrapes the pending
+        journal pages, replaces the pending arXiv identifiers by their DOIs
+        from arXiv_DOIs, a dict as returned by get_DOIs_from_arXiv(), and
+        returns the (label, DOI) pairs.
+    """
+    slots = None
+    if prefetch is not None:
+        slots = prefetch.slots
+    with profile_stage(options, 'journal page lookup'):
+        page_DOIs = get_DOIs_from_journal_pages(
+                        [DOI for DOI in all_DOIs
+                         if DOI.startswith(PAGE_DOI_PENDING)], options, slots)
+
+    all_DOIs = list(all_DOIs)
+    for ind in range(len(all_DOIs)):
+        if all_DOIs[ind].startswith(PAGE_DOI_PENDING):
+            all_DOIs[ind] = page_DOIs[all_DOIs[ind]]
+
+            if prefetch is not None and all_DOIs[ind] != 'DOI_NOT_FOUND' and \
+               not all_DOIs[ind].startswith(ARXIV_PENDING):
+                prefetch.add(all_DOIs[ind])
+
+        if all_DOIs[ind].startswith(ARXIV_PENDING):
+            all_DOIs[ind] = arXiv_DOIs[all_DOIs[ind][len(ARXIV_PENDING):]]
+
+            if prefetch is not None and all_DOIs[ind] != 'DOI_NOT_FOUND':
+                prefetch.add(all_DOIs[ind])
+
+        if options.verbose:
+            print(all_labels[ind], all_DOIs[ind])
+
+    if ("DOI_NOT_FOUND" in all_DOIs) and not options.force:
+        if outfilename is None:
+            raise BibMakerError("couldn't find all DOIs. "
+                                "Input file needs manual cleanup.")
+
+        outfile = open(outfilename, 'w')
+        for ind in range(len(all_labels)):
+            print(all_labels[ind], all_DOIs[ind], file=outfile)
+
+        outfile.close()
+        raise BibMakerError("couldn't find all DOIs. The labels and DOIs "
+                            "have been written to " + outfilename +
+                            " for manual cleanup.")
+
+    return [(label, DOI) for label, DOI in zip(all_labels, all_DOIs)
+            if DOI != 'DOI_NOT_FOUND']
+
+
+def read_input_file(inputfile):
+    """ Return the (label, DOI) pairs listed in the input file, in order.
+        The label is None if the row only contains a DOI. inputfile is a file
+        name or an open file.
+    """
+    if isinstance(inputfile, str):
+        with open(inputfile, 'r') as myfile:
+            return read_input_file(myfile)
+
+    doi_requests = []
+
+    for myline in inputfile:
         if len(myline) < 2 or myline[0] == '#': # empty line or comment
             continue
 
-        mysplit = myline.split(' ')
+        mysplit = myline.split()
+        if len(mysplit) == 0:
+            continue
 
         label = None
         if len(mysplit) == 2:
             label = mysplit[0]
-            if mysplit[1][-1] == "\n":
-                DOI = mysplit[1][:-1] # remove the new line character
+            DOI = mysplit[1]
         else:
-            if mysplit[0][-1] == "\n":
-                DOI = mysplit[0][:-1]
+            DOI = mysplit[0]
 
         if DOI.lower().find('doi.org') > -1:
             DOI = DOI[DOI.lower().find('doi.org')+8:]
@@ -498,268 +2172,1712 @@ def process_bibfile():
         if DOI == 'DOI_NOT_FOUND':
             continue
 
-        exitcode, output = subprocess.getstatusoutput(
-                f'curl -LH "Accept: application/x-bibtex" "http://dx.doi.org/' 
-                                                        + DOI + '"')
+        doi_requests.append((label, DOI))
+
+    return doi_requests
+
+
+def fetch_bibtex(DOI, options):
+    """ Download the bibtex entry of a DOI. This is the slow, network bound
+        part, so it is the one that runs in parallel.
+    """
+    # only keep proper bibtex entries in the cache, not error pages
+    return cached('bibtex', normalize_DOI(DOI),
+                  lambda: download_bibtex(DOI, options),
+                  options, keep=lambda output: output is not None)
+
+
+def download_bibtex(DOI, options):
+    """ Returns None if the DOI cannot be found.
+    """
+    try:
+        response = http_client().get('https://doi.org/' + DOI,
+                                     {'Accept': 'application/x-bibtex'})
+    except HTTPError as e:
+        report_download_error(e)
+        return None
+
+    if response.status != 200:
+        report_download_error(HTTPError(response.url, 'HTTP status ' +
+                                        str(response.status), response.status))
+        return None
+
+    output = response.text()
+    if output.find('@') == -1:
+        return None
+
+    # skip to the relevant part of the output
+    return output[output.find('@'):]
+
+
+CROSSREF_API = 'https://api.crossref.org/works'
+CROSSREF_BATCH_SIZE = 20
+# only ask crossref for the fields that are used
+CROSSREF_FIELDS = ['DOI', 'type', 'title', 'author', 'container-title',
+                   'volume', 'issue', 'page', 'article-number', 'publisher',
+                   'ISSN', 'issued', 'published-print', 'published-online']
+
+BIBTEX_MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+
+
+def get_crossref_works(DOIs, options):
+    """ Returns a dict from normalized DOI to the crossref metadata of the
+        DOIs that crossref knows (e.g. not the arXiv ones). The resolvers of
+        the options are asked in order, each one about the DOIs that the ones
+        before it did not know.
+    """
+    works = {}
+    missing = list(dict.fromkeys(normalize_DOI(DOI) for DOI in DOIs))
+
+    for resolver in options.resolvers:
+        if len(missing) == 0:
+            break
+
+        works.update(resolver.works(missing, options))
+        missing = [DOI for DOI in missing if DOI not in works]
+
+    return works
+
+
+def get_crossref_works_online(DOIs, options):
+    """ Like get_crossref_works(), asking crossref itself. The DOIs that
+        are not in the cache are looked up in bulk, CROSSREF_BATCH_SIZE of
+        them per query.
+    """
+    works = {}
+    missing = []
+
+    unique_DOIs = list(dict.fromkeys(normalize_DOI(DOI) for DOI in DOIs))
+
+    for DOI in unique_DOIs:
+        work = CACHE_MISS
+        if options.cache is not None and not options.refresh:
+            work = options.cache.get('crossref_work', DOI)
+
+        if work is CACHE_MISS:
+            missing.append(DOI)
+        elif work: # {} means that crossref does not know the DOI
+            works[DOI] = work
+
+    if options.cache is not None and not options.refresh:
+        profile_count(options, 'cache hits', len(unique_DOIs) - len(missing))
+        profile_count(options, 'cache misses', len(missing))
+
+    batches = [missing[i:i+CROSSREF_BATCH_SIZE]
+               for i in range(0, len(missing), CROSSREF_BATCH_SIZE)]
+
+    if len(batches) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, min(options.jobs,
+                                                       len(batches)))) as pool:
+            for batch, found in zip(batches, pool.map(fetch_crossref_works,
+                                                      batches)):
+                # None means that the query itself failed
+                if found is None:
+                    continue
+
+                for DOI in batch:
+                    if DOI in found:
+                        works[DOI] = found[DOI]
+                    if options.cache is not None:
+                        options.cache.put('crossref_work', DOI,
+                                          found.get(DOI, {}))
+
+    return works
+
+
+def fetch_crossref_works(DOIs):
+    """ Ask crossref about all the DOIs in a single query. Returns a dict
+        from normalized DOI to metadata, or None if the query failed.
+    """
+    query = urllib.parse.urlencode({
+                'filter': ','.join('doi:' + DOI for DOI in DOIs),
+                'select': ','.join(CROSSREF_FIELDS),
+                'rows': len(DOIs)})
+    try:
+        result = json.loads(http_client().get_text(CROSSREF_API + '?' + query,
+                                                   {'Accept':
+                                                    'application/json'}))
+    except (HTTPError, ValueError) as e:
+        print('### crossref query failed: ' + str(e))
+        return None
+
+    works = {}
+    for work in result.get('message', {}).get('items', []):
+        if 'DOI' in work:
+            works[normalize_DOI(work['DOI'])] = work
+
+    return works
+
+
+class CrossrefAPI:
+    """ The crossref resolver that asks api.crossref.org.
+    """
+
+    name = 'crossref'
+
+    def works(self, DOIs, options):
+        return get_crossref_works_online(DOIs, options)
+
+
+class CrossrefDump:
+    """ Offline index of crossref metadata, built from a snapshot with
+        ingest() and stored in a single SQLite file, with the normalized DOI
+        as its primary key. Only the CROSSREF_FIELDS of every work are kept.
+        It is a resolver, like CrossrefAPI.
+    """
+
+    name = 'dump'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+        dumpdir = os.path.dirname(filename)
+        if dumpdir != '':
+            os.makedirs(dumpdir, exist_ok=True)
+
+        self.db = sqlite3.connect(filename, timeout=30,
+                                  check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS works ('
+                            'doi TEXT PRIMARY KEY, work TEXT NOT NULL) '
+                            'WITHOUT ROWID')
+
+    def ingest(self, snapshot, batch_size=10000):
+        """ Add the works of a JSON-lines snapshot (a file name, gzipped if
+            it ends in .gz), replacing the ones that are already there.
+            Every line is a work, or an object with a list of works in
+            "items", possibly inside "message", as in the crossref API and
+            its public data files. Returns the number of works added.
+        """
+        if snapshot.endswith('.gz'):
+            infile = gzip.open(snapshot, 'rt', encoding='utf-8')
+        else:
+            infile = open(snapshot, 'r', encoding='utf-8')
+
+        count = 0
+        rows = []
+        with infile, self.lock:
+            for number, myline in enumerate(infile, 1):
+                if myline.strip() == '':
+                    continue
+
+                try:
+                    item = json.loads(myline)
+                except ValueError as e:
+                    raise BibMakerError(snapshot + ', line ' + str(number) +
+                                        ': ' + str(e))
+
+                item = item.get('message', item)
+                for work in item.get('items', [item]):
+                    if 'DOI' not in work:
+                        continue
+                    rows.append((normalize_DOI(work['DOI']), json.dumps(
+                        {field: work[field] for field in CROSSREF_FIELDS
+                         if field in work}, separators=(',', ':'))))
+
+                if len(rows) >= batch_size:
+                    count += self._insert(rows)
+                    rows = []
+
+            count += self._insert(rows)
+
+        return count
+
+    def _insert(self, rows):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO works VALUES (?, ?)',
+                                rows)
+        return len(rows)
+
+    def works(self, DOIs, options):
+        """ Returns a dict from normalized DOI to the works in the index.
+        """
+        works = {}
+        DOIs = [normalize_DOI(DOI) for DOI in DOIs]
+
+        with profile_stage(options, 'dump lookup'), self.lock:
+            # stay below the limit of SQLite on the number of parameters
+            for ind in range(0, len(DOIs), 500):
+                batch = DOIs[ind:ind+500]
+                for DOI, work in self.db.execute(
+                        'SELECT doi, work FROM works WHERE doi IN (' +
+                        ','.join('?' * len(batch)) + ')', batch):
+                    works[DOI] = json.loads(work)
+
+        profile_count(options, 'dump hits', len(works))
+        profile_count(options, 'dump misses', len(DOIs) - len(works))
+        return works
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def open_resolvers():
+    """ Set up RESOLVERS from the command line, and ingest the snapshots
+        given by --ingest into the dump.
+    """
+    global RESOLVERS, DUMP
+
+    names = RESOLVER_NAMES
+    if names is None:
+        names = ['dump', 'crossref'] if DUMP_FILE is not None else \
+                ['crossref']
+
+    dump = None
+    if DUMP_FILE is not None:
+        try:
+            dump = DUMP = CrossrefDump(DUMP_FILE)
+        except (OSError, sqlite3.Error) as e:
+            raise BibMakerError('could not open ' + DUMP_FILE + ': ' + str(e))
+
+    RESOLVERS = [dump if name == 'dump' else CrossrefAPI() for name in names]
+
+    for snapshot in INGEST_FILES:
+        print('### Ingesting ' + snapshot)
+        try:
+            count = dump.ingest(snapshot)
+        except (OSError, sqlite3.Error) as e:
+            raise BibMakerError('could not ingest ' + snapshot + ': ' +
+                                str(e))
+        print('### Added ' + str(count) + ' works to ' + DUMP_FILE)
+
+
+def close_resolvers():
+    global RESOLVERS, DUMP
+
+    if DUMP is not None:
+        DUMP.close()
+        DUMP = None
+    RESOLVERS = None
+
+
+def pages_from_crossref(work):
+    """ The article number, or else the first page, or None.
+    """
+    if work.get('article-number'):
+        return work['article-number']
+
+    if work.get('page'):
+        return work['page'].split('-')[0]
+
+    return None
+
+
+def bibtex_value(value):
+    """ Drop the braces of values that would not parse otherwise.
+    """
+    value = str(value).strip()
+    if value.count('{') != value.count('}'):
+        value = value.replace('{', '').replace('}', '')
+    return value
+
+
+def crossref_to_bibtex(work):
+    """ Write the bibtex entry of a journal article from its crossref
+        metadata, in the same form as the entries of doi.org. Returns None
+        for the other kinds of works, whose entries come from doi.org.
+    """
+    if work.get('type') != 'journal-article' or \
+       len(work.get('title', [])) == 0:
+        return None
+
+    authors = []
+    for author in work.get('author', []):
+        if 'family' in author and 'given' in author:
+            authors.append(author['family'] + ', ' + author['given'])
+        elif 'family' in author:
+            authors.append(author['family'])
+        elif 'name' in author:
+            authors.append('{' + author['name'] + '}')
+
+    date = []
+    for key in ['published-print', 'issued', 'published-online']:
+        if len(work.get(key, {}).get('date-parts', [[]])[0]) > 0 and \
+           work[key]['date-parts'][0][0] is not None:
+            date = work[key]['date-parts'][0]
+            break
+
+    # the label is made like the one of doi.org, e.g. Benalcazar_2017
+    family = 'Anonymous'
+    if len(work.get('author', [])) > 0:
+        first = work['author'][0]
+        family = first.get('family', first.get('name', family))
+    family = unicodedata.normalize('NFKD', family)
+    family = re.sub(r'[^A-Za-z0-9]', '', family) or 'Anonymous'
+    label = family
+    if len(date) > 0:
+        label += '_' + str(date[0])
+
+    fields = [('title', work['title'][0])]
+    if work.get('volume'):
+        fields.append(('volume', work['volume']))
+    if len(work.get('ISSN', [])) > 0:
+        fields.append(('ISSN', work['ISSN'][0]))
+    fields.append(('url', 'http://dx.doi.org/' + work['DOI']))
+    fields.append(('DOI', work['DOI']))
+    if work.get('issue'):
+        fields.append(('number', work['issue']))
+    if len(work.get('container-title', [])) > 0:
+        fields.append(('journal', work['container-title'][0]))
+    if work.get('publisher'):
+        fields.append(('publisher', work['publisher']))
+    if len(authors) > 0:
+        fields.append(('author', ' and '.join(authors)))
+    if len(date) > 0:
+        fields.append(('year', str(date[0])))
+
+    bibtex = '@article{' + label + ', '
+    bibtex += ', '.join(name + '={' + bibtex_value(value) + '}'
+                        for name, value in fields)
+
+    if len(date) > 1 and date[1] is not None and 1 <= date[1] <= 12:
+        bibtex += ', month=' + BIBTEX_MONTHS[date[1]-1]
+
+    pages = work.get('page') or work.get('article-number')
+    if pages:
+        pages = bibtex_value(pages).replace('--', '-').replace('-', '--')
+        bibtex += ', pages={' + pages + '}'
+
+    return bibtex + ' }'
+
+
+def fetch_all_bibtex(DOIs, options, jobs=None):
+    """ Fetch the bibtex entries of all DOIs using jobs (by default
+        options.jobs) parallel workers. The results are returned in the same
+        order as the DOIs.
+
+        The journal articles are written from the compact crossref metadata,
+        which is fetched for many DOIs at once and also has the article
+        numbers. Only the other DOIs (e.g. arXiv, books) are downloaded one
+        by one from doi.org, unless crossref is not one of the resolvers
+        (--resolvers dump), in which case they are not found (None).
+    """
+    if len(DOIs) == 0:
+        return []
+
+    online = any(isinstance(resolver, CrossrefAPI)
+                 for resolver in options.resolvers)
+
+    # a DOI that is listed several times is only fetched once, using its
+    # first spelling
+    unique_DOIs = {}
+    for DOI in DOIs:
+        unique_DOIs.setdefault(normalize_DOI(DOI), DOI)
+
+    with profile_stage(options, 'crossref lookup'):
+        works = get_crossref_works(list(unique_DOIs.values()), options)
+
+    def fetch(DOI):
+        start = time.perf_counter()
+        work = works.get(normalize_DOI(DOI))
+        output = None
+        if work is not None:
+            output = crossref_to_bibtex(work)
+
+        if output is not None:
+            profile_count(options, 'bibtex from crossref')
+        elif online:
+            profile_count(options, 'bibtex from doi.org')
+            output = fetch_bibtex(DOI, options)
+        else:
+            profile_count(options, 'not in the dump')
+
+        if options.profile is not None:
+            options.profile.add_DOI_time(DOI, time.perf_counter() - start)
+        return output
+
+    if jobs is None:
+        jobs = options.jobs
+
+    with profile_stage(options, 'bibtex download'):
+        if jobs <= 1:
+            outputs = dict(zip(unique_DOIs.keys(),
+                               map(fetch, unique_DOIs.values())))
+        else:
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                outputs = dict(zip(unique_DOIs.keys(),
+                                   pool.map(fetch, unique_DOIs.values())))
+
+    return [outputs[normalize_DOI(DOI)] for DOI in DOIs]
+
+
+class Prefetcher:
+    """ Downloads the bibtex of DOIs in the background, as soon as they are
+        added, CROSSREF_BATCH_SIZE of them at a time, so that the downloads
+        overlap with reading the input, e.g. a bbl file and its arXiv
+        lookups. Use it as a context manager, e.g.
+
+            with Prefetcher(options) as prefetch:
+                for DOI in DOIs:
+                    prefetch.add(DOI)
+                fetched = prefetch.results()
+
+        The DOIs in skip (normalized) are not downloaded. Every batch is
+        downloaded by one worker, and one of the options.jobs is left to the
+        thread that reads the input. Every batch holds one of the slots, a
+        semaphore of options.jobs, which the other downloads of the input
+        share (e.g. the arXiv lookups), so that there are at most
+        options.jobs downloads at a time.
+    """
+
+    def __init__(self, options, skip=()):
+        self.options = options
+        self.skip = set(skip)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, options.jobs - 1))
+        self.slots = threading.BoundedSemaphore(max(1, options.jobs))
+        self.pending = []
+        self.batches = [] # (normalized DOIs, future of their bibtex)
+        self.seen = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # do not wait for the downloads if the input could not be read
+        self.pool.shutdown(wait=exc_type is None,
+                           cancel_futures=exc_type is not None)
+
+    def add(self, DOI):
+        if normalize_DOI(DOI) in self.seen or \
+           normalize_DOI(DOI) in self.skip:
+            return
+
+        self.seen.add(normalize_DOI(DOI))
+        self.pending.append(DOI)
+        if len(self.pending) >= CROSSREF_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        batch = self.pending
+        self.pending = []
+        self.batches.append(([normalize_DOI(DOI) for DOI in batch],
+                             self.pool.submit(self.fetch, batch)))
+
+    def fetch(self, batch):
+        with self.slots:
+            return fetch_all_bibtex(batch, self.options, 1)
+
+    def results(self):
+        """ Wait for all the downloads. Returns a dict from normalized DOI
+            to bibtex, as taken by BibBuilder.build().
+        """
+        self.flush()
+
+        fetched = {}
+        with profile_stage(self.options, 'prefetch wait'):
+            for DOIs, future in self.batches:
+                fetched.update(zip(DOIs, future.result()))
+
+        return fetched
+
+
+# the start of an entry of a bib file, up to its label
+BIB_ENTRY_RE = re.compile(r'@\s*([A-Za-z]+)\s*([{(])\s*([^,\s]+)\s*,')
+
+
+def read_existing_entries(bibfile):
+    """ Returns the entries of an existing bib file, or an empty
+        BibliographyData if there is no such file. The text of every entry
+        is kept in its bibtex attribute, so that the entries that are kept
+        are written out as they are, see BibRecord.from_entry().
+    """
+    if not os.path.exists(bibfile):
+        return BibliographyData()
+
+    try:
+        with open(bibfile, 'r', encoding='utf-8') as infile:
+            text = infile.read()
+        bib = parse_file(bibfile, 'bibtex')
+    except Exception as e:
+        raise BibMakerError('could not read ' + bibfile + ': ' + str(e))
+
+    for label, bibtex in split_bib_entries(text):
+        if label in bib.entries:
+            bib.entries[label].bibtex = bibtex
+
+    return bib
+
+
+def split_bib_entries(text):
+    """ Yields (label, text of the entry) for the entries of a bib file.
+        The entries end at the brace (or parenthesis) that closes them.
+    """
+    pos = 0
+    while True:
+        match = BIB_ENTRY_RE.search(text, pos)
+        if match is None:
+            return
+
+        depth = 0
+        close = '}' if match.group(2) == '{' else ')'
+        for ind in range(match.end(), len(text)):
+            char = text[ind]
+            if char == '{':
+                depth += 1
+            elif depth > 0 and char == '}':
+                depth -= 1
+            elif depth == 0 and char == close:
+                break
+        else:
+            return # not closed
+
+        if match.group(1).lower() not in ('comment', 'string', 'preamble'):
+            yield match.group(3), text[match.start():ind+1] + '\n'
+        pos = ind + 1
+
+
+# the characters that are escaped in the DOIs of bib files
+DOI_ESCAPE_RE = re.compile(r'\\([_%&#$])')
+
+
+def entry_DOI(entry):
+    """ The normalized DOI of an Entry read from a bib file, from its DOI
+        field or else its doi.org url, or None.
+    """
+    DOI = entry.fields.get('DOI')
+    if DOI is None:
+        url = entry.fields.get('url', '')
+        if url.lower().find('doi.org/') == -1:
+            return None
+        DOI = url
+
+    return normalize_DOI(DOI_ESCAPE_RE.sub(r'\1', DOI))
+
+
+def match_existing_entries(doi_requests, existing):
+    """ Find the rows of the input file that are already in the bib file.
+        A row with a label matches the entry with that label, if it has the
+        same DOI. A row without a label matches any entry with the same DOI.
+        Every entry is matched at most once. Returns a dict from the row
+        number to the existing Entry.
+    """
+    labels_by_DOI = {}
+    for key, entry in existing.entries.items():
+        if entry_DOI(entry) is not None:
+            labels_by_DOI.setdefault(entry_DOI(entry), []).append(key)
+
+    used = set()
+    kept = {}
+
+    # rows with labels first, so they get their own entries
+    for ind, (label, DOI) in enumerate(doi_requests):
+        if label is None or label not in existing.entries:
+            continue
+
+        entry = existing.entries[label]
+        if entry.key.lower() not in used and \
+           entry_DOI(entry) == normalize_DOI(DOI):
+            used.add(entry.key.lower())
+            kept[ind] = entry
+
+    for ind, (label, DOI) in enumerate(doi_requests):
+        if label is not None:
+            continue
+
+        for key in labels_by_DOI.get(normalize_DOI(DOI), []):
+            if key.lower() not in used:
+                used.add(key.lower())
+                kept[ind] = existing.entries[key]
+                break
 
-        # skip to the relevant part of the output
-        output = output[output.find('@'):]
+    return kept
 
+
+def label_suffixes():
+    """ The suffixes of repeated labels: a, b, ..., z, aa, ab, ..., zz,
+        aaa, and so on.
+    """
+    for length in itertools.count(1):
+        for letters in itertools.product(alphabet, repeat=length):
+            yield ''.join(letters)
+
+
+def assign_labels(doi_requests, outputs, options):
+    """ Pick the label of every entry, sequentially and in input order, so
+        that the de-duplication of repeated labels is deterministic.
+        Returns a list of (label, DOI, output) for the DOIs that were found.
+        An output can also be an Entry kept from the existing bib file, which
+        keeps its label.
+    """
+    # lower case, because pybtex does not tell the labels apart otherwise
+    used_labels = set(output.key.lower() for output in outputs
+                      if isinstance(output, Entry))
+    suffixes = {} # label -> its remaining suffixes
+    labelled = []
+
+    for (label, DOI), output in zip(doi_requests, outputs):
         # the DOI is wrong
-        if output.find('This DOI cannot be found in the DOI System.') > -1:
-            if not FORCE:
-                rtfm(DOI + ' not found.')
-            if VERBOSE:
+        if output is None:
+            if not options.force:
+                raise BibMakerError(DOI + ' not found.')
+            if options.verbose:
                 print('### ' + DOI + ' not found.')
 
             continue
 
+        # already in the bib file, its label has been reserved above
+        if isinstance(output, Entry):
+            labelled.append((output.key, DOI, output))
+            continue
+
         if label is None: # get label if it doesn't exist
             label = output[output.find('{')+1:output.find(',')]
 
             if label.lower().find('arxiv') > -1: # shorten arXiv auto-labels
                 label = label[label.lower().find('arxiv'):]
 
-        # check for repeated labels and correct if necessary 
-        if label in all_labels:
-            for letter in alphabet:
-                if label+letter in all_labels:
+        # check for repeated labels and correct if necessary
+        if label.lower() in used_labels:
+            remaining = suffixes.setdefault(label, label_suffixes())
+            suffixed = label + next(remaining)
+            while suffixed.lower() in used_labels:
+                suffixed = label + next(remaining)
+            label = suffixed
+        used_labels.add(label.lower())
+
+        labelled.append((label, DOI, output))
+
+    return labelled
+
+
+JOURNAL_PAGE_RULES = None # prefix trie of journal names
+JOURNAL_PAGE_RULES_LOCK = threading.Lock()
+PAGE_RULE = object() # trie key of the rule of a journal
+
+
+def journal_page_rules():
+    """ The prefix trie built from journal_page_rules.csv on first use. Each
+        row of the file gives the beginning of a journal name, and the way in
+        which the pages of the papers in that journal are found.
+    """
+    global JOURNAL_PAGE_RULES
+
+    with JOURNAL_PAGE_RULES_LOCK:
+        if JOURNAL_PAGE_RULES is not None:
+            return JOURNAL_PAGE_RULES
+
+        SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+        file_path = os.path.join(SCRIPT_DIR, 'journal_page_rules.csv')
+
+        trie = {}
+        with open(file_path, 'r', newline='', encoding='utf-8') as csvfile:
+            for row in csv.reader(csvfile):
+                # skip bad lines
+                if len(row) != 2 or row[1] not in PAGE_STRATEGIES:
                     continue
-                else:
-                    label = label+letter
-                    all_labels.append(label)
-                    break
+
+                node = trie
+                for char in row[0]:
+                    node = node.setdefault(char, {})
+                node[PAGE_RULE] = (row[0], row[1])
+
+        JOURNAL_PAGE_RULES = trie
+        return JOURNAL_PAGE_RULES
+
+
+def find_page_rule(journal):
+    """ Returns (journal prefix, strategy) for the longest prefix of the
+        journal name that has a rule, or None.
+    """
+    rule = None
+    node = journal_page_rules()
+
+    for char in journal.replace('&amp;', '&').replace('\\&', '&'):
+        if char not in node:
+            break
+        node = node[char]
+        rule = node.get(PAGE_RULE, rule)
+
+    return rule
+
+
+def DOI_suffix(entry, DOI, options):
+    return entry.fields['DOI'][entry.fields['DOI'].rfind('.')+1:]
+
+
+def e_DOI_suffix(entry, DOI, options):
+    return 'e' + DOI_suffix(entry, DOI, options)
+
+
+def short_DOI_suffix(entry, DOI, options):
+    return entry.fields['DOI'][entry.fields['DOI'].rfind('.')+3:]
+
+
+def article_number(entry, DOI, options):
+    # get the pages by scraping the journal site
+    return get_article_number(DOI, options)
+
+
+def crossref_pages(entry, DOI, options):
+    # scraping some of the websites does not work directly, so we use
+    # crossref
+    if not options.experimental:
+        return None
+
+    return get_pages_using_crossref(DOI, options)
+
+
+PAGE_STRATEGIES = {'doi_suffix': DOI_suffix,
+                   'e_doi_suffix': e_DOI_suffix,
+                   'short_doi_suffix': short_DOI_suffix,
+                   'article_number': article_number,
+                   'crossref': crossref_pages,
+                  }
+
+
+def get_pages_by_rule(entry, DOI, options):
+    """ Find the missing pages of an article using the rule of its journal.
+        Returns None if there is no rule, or if it did not work.
+    """
+    rule = find_page_rule(entry.fields['journal'])
+    if rule is None:
+        return None
+
+    if rule[1] in ('doi_suffix', 'e_doi_suffix', 'short_doi_suffix') and \
+       'DOI' not in entry.fields:
+        return None
+
+    return PAGE_STRATEGIES[rule[1]](entry, DOI, options)
+
+
+# an HTML/MathML tag, without the namespace of its name
+MARKUP_TAG_RE = re.compile(r'<(/?)(?:[A-Za-z][\w.-]*:)?([A-Za-z][\w.-]*)'
+                           r'[^<>]*>')
+# splits a title into text, and the tags and HTML entities in between
+MARKUP_SPLIT_RE = re.compile(r'(<(?:/?)(?:[A-Za-z][\w.-]*:)?[A-Za-z][\w.-]*'
+                             r'[^<>]*>'
+                             r'|&(?:#[0-9]+|#[xX][0-9A-Fa-f]+|[A-Za-z]+[0-9]*);)')
+# the tags and entities seen so far -> see parse_markup_tag()
+MARKUP_TAG_CACHE = {}
+MARKUP_TAG_CACHE_SIZE = 1000
+
+# tags that have a LaTeX equivalent, the other tags are dropped
+MARKUP_TAGS = {'i': ('\\textit{', '}'),
+               'em': ('\\textit{', '}'),
+               'b': ('\\textbf{', '}'),
+               'strong': ('\\textbf{', '}'),
+               'scp': ('\\textsc{', '}'),
+               'sub': ('$_{', '}$'),
+               'sup': ('$^{', '}$'),
+               'math': ('$', '$'),
+              }
+
+# the tags of MARKUP_TAGS that are written as inline math
+MATH_TAGS = ('sub', 'sup', 'math')
+
+# what is written before the second and third child of MathML scripts
+MATHML_SCRIPTS = {'msub': ['_{'],
+                  'msup': ['^{'],
+                  'msubsup': ['_{', '}^{'],
+                  'munder': ['_{'],
+                  'mover': ['^{'],
+                  'munderover': ['_{', '}^{'],
+                 }
+
+# fields that hold URLs and identifiers, not text
+UNCLEANED_FIELDS = ['url', 'DOI', 'ISSN']
+
+
+def parse_markup_tag(token):
+    """ (closing, lower case name without namespace, empty) of a tag, e.g.
+        '<mml:mi>', or (None, is it &amp;, the character) of an entity. The
+        tags of MathML repeat a lot, so they are parsed once.
+    """
+    info = MARKUP_TAG_CACHE.get(token)
+    if info is not None:
+        return info
+
+    if token[0] == '&':
+        info = (None, token == '&amp;', html.unescape(token))
+    else:
+        match = MARKUP_TAG_RE.fullmatch(token)
+        info = (match.group(1) == '/', match.group(2).lower(),
+                token[-2] == '/')
+    if len(MARKUP_TAG_CACHE) < MARKUP_TAG_CACHE_SIZE:
+        MARKUP_TAG_CACHE[token] = info
+
+    return info
+
+
+def clean_markup(text):
+    """ Turn the HTML and MathML markup that publishers put in titles into
+        LaTeX, in a single pass: <i>, <sub>, <sup> etc. become \\textit{},
+        $_{}$, $^{}$, MathML becomes inline math (with subscripts and
+        superscripts), other tags are dropped, and entities are decoded.
+        The title is split on the tags and entities by MARKUP_SPLIT_RE, and
+        every tag is parsed once, see parse_markup_tag().
+    """
+    if '<' not in text and '&' not in text:
+        return text
+
+    parts = MARKUP_SPLIT_RE.split(text)
+    if len(parts) == 1:
+        return text
+
+    pieces = [parts[0]]
+    append = pieces.append
+    cached = MARKUP_TAG_CACHE.get
+    depth = 0
+    scripts = [] # [tag, depth, number of children] of the open scripts
+    opened = [] # the open tags of MARKUP_TAGS, so that braces stay balanced
+
+    # the tags and entities are at the odd indices, the text in between
+    for ind in range(1, len(parts), 2):
+        info = cached(parts[ind])
+        if info is None:
+            info = parse_markup_tag(parts[ind])
+        closing, tag, empty = info
+
+        if closing is None: # an entity
+            # the writer escapes &, but not in the inline math
+            if tag and any(name in MATH_TAGS for name in opened):
+                append('\\&')
+            else:
+                append(empty)
+        elif closing:
+            if depth > 0:
+                depth -= 1
+            if scripts and scripts[-1][1] == depth and scripts[-1][0] == tag:
+                if scripts.pop()[2] > 1:
+                    append('}')
+            if opened and opened[-1] == tag:
+                append(MARKUP_TAGS[opened.pop()][1])
         else:
-            all_labels.append(label)
+            # a new child of an open script
+            if scripts and scripts[-1][1] == depth - 1:
+                script = scripts[-1]
+                if 1 <= script[2] <= len(MATHML_SCRIPTS[script[0]]):
+                    append(MATHML_SCRIPTS[script[0]][script[2]-1])
+                script[2] += 1
+
+            if not empty:
+                if tag in MARKUP_TAGS:
+                    append(MARKUP_TAGS[tag][0])
+                    opened.append(tag)
+                elif tag in MATHML_SCRIPTS:
+                    scripts.append([tag, depth, 0])
+                depth += 1
+
+        if parts[ind+1]:
+            append(parts[ind+1])
+
+    # close whatever the publisher left open
+    for script in reversed(scripts):
+        if script[2] > 1:
+            append('}')
+    while opened:
+        append(MARKUP_TAGS[opened.pop()][1])
+
+    return ''.join(pieces)
+
+
+def clean_fields(entry):
+    """ Remove the markup from all text fields of the entry.
+    """
+    for name in list(entry.fields.keys()):
+        if name not in UNCLEANED_FIELDS:
+            entry.fields[name] = clean_markup(entry.fields[name])
 
-        # assign correct label
-        output = output[:output.find('{')+1] + label + \
-                                    output[output.find(','):]
 
-        # handle arXiv entries separately
-        if DOI.lower().find('arxiv') > -1:
-            output = '@article' + output[output.find('{'):]
+def parse_entry(label, DOI, output, options):
+    """ Parse the downloaded bibtex of DOI as the entry label. arXiv entries
+        become articles in the journal arXiv:<identifier>. This is the only
+        place where the bibtex is parsed. Returns the pybtex Entry.
+    """
+    # assign correct label
+    output = output[:output.find('{')+1] + label + \
+                                output[output.find(','):]
+
+    # handle arXiv entries separately
+    if DOI.lower().find('arxiv') > -1:
+        output = '@article' + output[output.find('{'):]
+        with profile_stage(options, 'pybtex parse'):
             bib_entry = pybtex.database.parse_string(output, "bibtex")
-            bib_entry.entries[label].fields['pages'] = ' '
-            bib_entry.entries[label].fields['journal'] = 'arXiv:' + \
-                bib_entry.entries[label].fields['DOI'][
-                    bib_entry.entries[label].fields['DOI'].find('/'):
-                                                       ][7:]
+        bib_entry.entries[label].fields['pages'] = ' '
+        bib_entry.entries[label].fields['journal'] = 'arXiv:' + \
+            bib_entry.entries[label].fields['DOI'][
+                bib_entry.entries[label].fields['DOI'].find('/'):
+                                                   ][7:]
+        return bib_entry.entries[label]
+
+    with profile_stage(options, 'pybtex parse'):
+        bib_entry = pybtex.database.parse_string(output, "bibtex")
+    return bib_entry.entries[label]
 
-            # fix capitalization in titles
+
+def finalize_entry(label, DOI, output, options):
+    """ Turn the downloaded bibtex into the final entry: parse it with
+        parse_entry(), fill in missing pages and clean up the title. Returns
+        the pybtex Entry and whether the pages are still missing.
+    """
+    entry = parse_entry(label, DOI, output, options)
+
+    # check for missing pages in articles, the arXiv entries have ' '
+    if ("pages" not in entry.fields) and \
+       (entry.type.lower() == "article") and \
+       ("journal" in entry.fields):
+        with profile_stage(options, 'page fixups'):
+            pages = get_pages_by_rule(entry, DOI, options)
+        if pages is not None:
+            entry.fields['pages'] = pages
+
+    # remove MathML and HTML markup from all fields
+    with profile_stage(options, 'title cleanup'):
+        clean_fields(entry)
+
+    # fix capitalization in titles
+    try:
+        entry.fields["title"] = "{" + entry.fields["title"] + "}"
+    except:
+        pass
+
+    return entry, ("pages" not in entry.fields)
+
+
+# the inline math written by clean_markup(), which must not be escaped
+INLINE_MATH_RE = re.compile(r'(\$[^$]*\$)')
+
+
+def encode_latex(text, encoding='utf-8'):
+    """ Escape the text of a field the way pybtex does, except for the
+        inline math, in which _ etc. are not escaped.
+    """
+    import latexcodec # registers the ulatex codec, slow to import
+
+    return ''.join(part if ind % 2 == 1 else
+                   codecs.encode(part, 'ulatex+' + encoding)
+                   for ind, part in enumerate(INLINE_MATH_RE.split(text)))
+
+
+def bibtex_writer(**kwargs):
+    """ The bibtex writer of pybtex, with the fields escaped by
+        encode_latex().
+    """
+    from pybtex.database.output.bibtex import Writer
+
+    writer = Writer(**kwargs)
+    writer._encode = lambda text: encode_latex(text, writer.encoding)
+    return writer
+
+
+class Bibliography(BibliographyData):
+    """ The BibliographyData returned by BibBuilder.build(). As bibtex, it
+        is written by bibtex_writer(), so that the inline math of the titles
+        stays valid LaTeX.
+    """
+
+    def _writer(self, bib_format, filename=None, **kwargs):
+        if bib_format == 'bibtex' or \
+           (bib_format is None and filename is not None and
+            filename.endswith('.bib')):
+            return bibtex_writer(**kwargs)
+        return None
+
+    def to_string(self, bib_format, **kwargs):
+        writer = self._writer(bib_format, **kwargs)
+        if writer is None:
+            return super().to_string(bib_format, **kwargs)
+        return writer.to_string(self)
+
+    def to_bytes(self, bib_format, **kwargs):
+        writer = self._writer(bib_format, **kwargs)
+        if writer is None:
+            return super().to_bytes(bib_format, **kwargs)
+        return writer.to_bytes(self)
+
+    def to_file(self, file, bib_format=None, **kwargs):
+        filename = file if isinstance(file, str) else \
+                   getattr(file, 'name', None)
+        writer = self._writer(bib_format, filename, **kwargs)
+        if writer is None:
+            return super().to_file(file, bib_format, **kwargs)
+        return writer.write_file(self, file)
+
+
+class BibRecord:
+    """ A finished bib entry, holding only what is written to the bib file:
+        its type, its label, and its fields in order, as strings. It is much
+        smaller than a pybtex Entry, so that large bibliographies can be
+        written out one entry at a time, see BibWriter. bibtex is the text of
+        an entry kept from an existing bib file, which is written instead of
+        the fields.
+    """
+
+    __slots__ = ('type', 'label', 'fields', 'bibtex')
+
+    def __init__(self, type, label, fields, bibtex=None):
+        self.type = type
+        self.label = label
+        self.fields = fields
+        self.bibtex = bibtex
+
+    @classmethod
+    def from_entry(cls, label, entry):
+        """ Copy the fields of a pybtex Entry, with the names written the
+            way pybtex writes them, and its text if it has been read by
+            read_existing_entries().
+        """
+        fields = {}
+        for role, persons in entry.persons.items():
+            fields[role] = ' and '.join(format_person(person)
+                                        for person in persons)
+        fields.update(entry.fields.items())
+
+        return cls(entry.original_type, label, fields,
+                   getattr(entry, 'bibtex', None))
+
+    def to_entry(self):
+        """ A pybtex Entry with the same fields, in which the authors and
+            editors are Persons again, as if it had been parsed.
+        """
+        fields = {}
+        persons = {}
+        for name, value in self.fields.items():
+            if name.lower() in Person.valid_roles:
+                persons[name] = [Person(person)
+                                 for person in split_name_list(value)]
+            else:
+                fields[name] = value
+
+        return Entry(self.type, fields=fields, persons=persons)
+
+    def to_bibtex(self):
+        """ The entry in the same form as pybtex writes it, except for the
+            inline math, in which _ etc. are not escaped.
+        """
+        if self.bibtex is not None:
+            return self.bibtex
+
+        lines = ['@' + self.type + '{' + self.label]
+        for name, value in self.fields.items():
+            value = encode_latex(value)
+            if '"' in value:
+                value = '{' + value + '}'
+            else:
+                value = '"' + value + '"'
+            lines.append('    ' + name + ' = ' + value)
+
+        return ',\n'.join(lines) + '\n}\n'
+
+
+def format_person(person):
+    """ Last, First, as pybtex writes the names.
+    """
+    def join(names):
+        return ' '.join([name for name in names if name])
+
+    name = ''
+    if person.get_part_as_text('last'):
+        name += join([person.get_part_as_text('prelast'),
+                      person.get_part_as_text('last')])
+    if person.get_part_as_text('lineage'):
+        name += ', ' + person.get_part_as_text('lineage')
+    if person.get_part_as_text('first') or person.get_part_as_text('middle'):
+        name += ', ' + join([person.get_part_as_text('first'),
+                             person.get_part_as_text('middle')])
+
+    return name
+
+
+class BibWriter:
+    """ Writes BibRecords to an open file as soon as they are done, and
+        keeps track of the articles without pages. If echo is set, the
+        entries are also printed.
+    """
+
+    def __init__(self, outfile, echo=False):
+        self.outfile = outfile
+        self.echo = echo
+        self.count = 0
+        self.missing = [] # (label, URL) of the entries without pages
+
+    def write(self, record):
+        bibtex = record.to_bibtex()
+        if self.count > 0:
+            bibtex = '\n' + bibtex
+        self.outfile.write(bibtex)
+        if self.echo:
+            print(bibtex)
+        self.count += 1
+
+        if 'pages' not in record.fields:
+            self.missing.append((record.label, 'http://dx.doi.org/' +
+                                 record.fields.get('DOI', '')))
+
+
+class BibBuilder:
+    """ Builds bibliographies from lists of DOIs, without touching the
+        command line settings, so that it can be used as a library. The
+        builds of one BibBuilder may run concurrently, and they share its
+        cache and the HTTP connections, e.g.
+
+            builder = BibBuilder(Options(force=True))
+            bib = builder.build(['10.1103/PhysRevB.96.245115'])
+            print(bib.to_string('bibtex'))
+    """
+
+    def __init__(self, options=None):
+        if options is None:
+            options = Options()
+        self.options = options
+
+    def read_input(self, inputfilename):
+        """ Returns the (label, DOI) pairs of an input file or a bbl file.
+        """
+        if inputfilename[-4:] == '.bbl':
+            return extract_input_from_bbl(inputfilename, self.options)
+
+        return read_input_file(inputfilename)
+
+    def read_batch(self, inputfilenames):
+        """ Like read_input(), for several files at once, which are read in
+            parallel. The arXiv identifiers of all the bbl files are looked
+            up together, so that each one is looked up once. Returns a list
+            where a file that could not be read gets its BibMakerError
+            instead of its (label, DOI) pairs.
+        """
+        options = self.options
+
+        def read(inputfilename):
             try:
-                bib_entry.entries[label].fields["title"] = "{" + \
-                    bib_entry.entries[label].fields["title"] + "}"
-            except:
-                pass
+                if inputfilename[-4:] == '.bbl':
+                    return read_bbl_entries(inputfilename, options)
+                return read_input_file(inputfilename)
+            except (BibMakerError, OSError) as e:
+                return BibMakerError(str(e))
+
+        with ThreadPoolExecutor(max_workers=max(1, options.jobs)) as pool:
+            documents = list(pool.map(read, inputfilenames))
+
+        with profile_stage(options, 'arXiv lookup'):
+            arXiv_DOIs = get_DOIs_from_arXiv(
+                            [arXiv_id for inputfilename, document
+                             in zip(inputfilenames, documents)
+                             if inputfilename[-4:] == '.bbl' and
+                                not isinstance(document, BibMakerError)
+                             for arXiv_id in pending_arXiv_ids(document[1])],
+                            options)
+
+        for ind, inputfilename in enumerate(inputfilenames):
+            if inputfilename[-4:] != '.bbl' or \
+               isinstance(documents[ind], BibMakerError):
+                continue
 
-            if VERBOSE:
-                print(bib_entry.to_string('bibtex'))
+            try:
+                documents[ind] = resolve_bbl_entries(*documents[ind],
+                                                     arXiv_DOIs, options)
+            except BibMakerError as e:
+                documents[ind] = e
+
+        return documents
+
+    def iter_build_bbl(self, bblfile, existing=None, outfilename=None):
+        """ Like iter_build(), for the entries of a bbl file (a file name or
+            an open file). The DOIs are downloaded while the rest of the bbl
+            file is still being read and its arXiv identifiers are looked
+            up, instead of afterwards. outfilename is as for
+            extract_input_from_bbl().
+        """
+        skip = ()
+        if existing is not None:
+            skip = [entry_DOI(entry) for entry in existing.entries.values()
+                    if entry_DOI(entry) is not None]
+
+        with Prefetcher(self.options, skip) as prefetch:
+            doi_requests = extract_input_from_bbl(bblfile, self.options,
+                                                  outfilename, prefetch)
+            fetched = prefetch.results()
+
+        return self.iter_build(doi_requests, existing, fetched)
+
+    def build(self, doi_requests, existing=None, fetched=None):
+        """ Returns a Bibliography with one entry per DOI, in order.
+            doi_requests holds DOIs, or (label, DOI) pairs where the label
+            may be None. Entries of the existing BibliographyData that are
+            still requested are reused instead of being downloaded again.
+            fetched is a dict from normalized DOI to the bibtex that has
+            already been downloaded, e.g. for another document; those DOIs
+            are not fetched again.
+        """
+        bib = Bibliography()
+        for record in self.iter_build(doi_requests, existing, fetched):
+            bib.add_entry(record.label, record.to_entry())
+
+        return bib
+
+    def iter_build(self, doi_requests, existing=None, fetched=None):
+        """ Like build(), but returns an iterator over the BibRecords of the
+            entries, in order, so that they can be written out while the
+            later ones are still being finalized.
+
+            The entries are built in three stages: fetch all DOIs in
+            parallel, assign the labels in input order, then post-process the
+            entries in parallel. The first two stages are done before this
+            returns, so that errors are raised before anything is written.
+        """
+        options = self.options
+
+        doi_requests = [(None, item) if isinstance(item, str) else tuple(item)
+                        for item in doi_requests]
+
+        kept = {}
+        if existing is not None:
+            kept = match_existing_entries(doi_requests, existing)
+            if options.verbose:
+                print('### Keeping ' + str(len(kept)) + ' entries, fetching ' +
+                      str(len(doi_requests) - len(kept)))
+                print()
+
+        # stage 1: download everything, network latency is the bottleneck
+        if fetched is None:
+            fetched = {}
+
+        outputs = [kept.get(ind) for ind in range(len(doi_requests))]
+        to_fetch = []
+        for ind, (label, DOI) in enumerate(doi_requests):
+            if ind in kept:
+                continue
+            if normalize_DOI(DOI) in fetched:
+                outputs[ind] = fetched[normalize_DOI(DOI)]
+            else:
+                to_fetch.append(ind)
+
+        with profile_stage(options, 'fetch'):
+            new_outputs = fetch_all_bibtex([doi_requests[ind][1]
+                                            for ind in to_fetch], options)
+
+        for ind, output in zip(to_fetch, new_outputs):
+            outputs[ind] = output
+
+        # stage 2: labels must be handed out in input order
+        with profile_stage(options, 'labels'):
+            labelled = assign_labels(doi_requests, outputs, options)
+
+        return self._finalize_all(labelled)
+
+    def _finalize_all(self, labelled):
+        options = self.options
+
+        def finalize(item):
+            label, DOI, output = item
+            # the kept entries have been abbreviated already
+            if isinstance(output, Entry):
+                return BibRecord.from_entry(label, output)
+
+            start = time.perf_counter()
+            record = BibRecord.from_entry(label, finalize_entry(
+                                        label, DOI, output, options)[0])
+            if 'journal' in record.fields:
+                with profile_stage(options, 'abbreviation'):
+                    record.fields['journal'] = abbreviate_journal_name(
+                                            record.fields['journal'], options)
+
+            if options.profile is not None:
+                options.profile.add_DOI_time(DOI, time.perf_counter() - start)
+            return record
+
+        # stage 3: page fixups may also need the network, so run them in
+        # parallel as well, but keep the results in order. Only a window of
+        # entries is in flight, so that the finished ones do not pile up
+        # behind a slow one, and every entry is let go once it is submitted.
+        window = 2 * max(1, options.jobs)
+        pending = collections.deque()
+        with profile_stage(options, 'finalize'), \
+             ThreadPoolExecutor(max_workers=max(1, options.jobs)) as pool:
+            for ind in range(len(labelled)):
+                pending.append(pool.submit(finalize, labelled[ind]))
+                labelled[ind] = None
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+
+    def fetch_batch(self, documents):
+        """ Download the DOIs of several documents (lists of doi_requests, as
+            for build()) at the same time, each DOI once. Returns a dict from
+            normalized DOI to bibtex, for the fetched argument of build() and
+            iter_build().
+        """
+        # the first spelling of every DOI is the one that is fetched
+        DOIs = {}
+        for doi_requests in documents:
+            for item in doi_requests:
+                DOI = item if isinstance(item, str) else item[1]
+                DOIs.setdefault(normalize_DOI(DOI), DOI)
+
+        with profile_stage(self.options, 'fetch'):
+            return dict(zip(DOIs.keys(),
+                            fetch_all_bibtex(list(DOIs.values()),
+                                             self.options)))
+
+    def build_batch(self, documents):
+        """ Build several bibliographies. documents is a list of
+            doi_requests, as for build(). Returns the list of results, where
+            a document that failed gets its BibMakerError instead of a
+            BibliographyData. The DOIs that several documents have in common
+            are fetched only once, see fetch_batch().
+        """
+        fetched = self.fetch_batch(documents)
+
+        results = []
+        for doi_requests in documents:
+            try:
+                results.append(self.build(doi_requests, fetched=fetched))
+            except BibMakerError as e:
+                results.append(e)
 
-            print(bib_entry.to_string('bibtex'), file=outfile)
-            print('', file=outfile)
-            continue
+        return results
 
 
-        # not an arXiv entry, move on
-        bib_entry = pybtex.database.parse_string(output, "bibtex")
+def missing_pages(bib):
+    """ Returns (label, URL) for the articles of the BibliographyData that
+        have no page numbers.
+    """
+    return [(label, 'http://dx.doi.org/' + entry.fields.get('DOI', ''))
+            for label, entry in bib.entries.items()
+            if "pages" not in entry.fields]
 
-        # check for missing pages in articles
-        if ("pages" not in bib_entry.entries[label].fields) and \
-           (output[:8] == "@article"):
-            # manually add pages for some papers
-            manual_page_journals = ['SciPost Physics',
-                                    'Journal of the Physical Society of Japan',
-                                    'Advances in Physics: X'
-                                    ]
-
-            for mpj in manual_page_journals:
-                if (bib_entry.entries[label].fields['journal'].find(
-                                            mpj) == 0):
-                    bib_entry.entries[label].fields['pages'] = \
-                        bib_entry.entries[label].fields['DOI'][
-                           bib_entry.entries[label].fields['DOI'].rfind('.')+1:
-                                                               ]
-
-            # some pages need extra work when they are manually added
-            manual_page_journals2 = ['Science Advances',
-                                    ]
-
-            for mpj2 in manual_page_journals2:
-                if (bib_entry.entries[label].fields['journal'].find(
-                                            mpj2) == 0):
-                    bib_entry.entries[label].fields['pages'] = 'e' + \
-                        bib_entry.entries[label].fields['DOI'][
-                           bib_entry.entries[label].fields['DOI'].rfind('.')+1:
-                                                               ]
-
-            manual_page_journals3 = ['Advanced Materials',
-                                     'Advanced Functional Materials',
-                                     'Advanced Materials Interfaces',
-                                     'Small',
-                                     'Advanced Science',
-                                     'Advanced Physics Research',
-                                     'Annalen der Physik',
-                                     'Laser &amp; Photonics Reviews'
-                                     ]
-
-            for mpj3 in manual_page_journals3:
-                if (bib_entry.entries[label].fields['journal'].find(
-                                            mpj3) == 0):
-                    bib_entry.entries[label].fields['pages'] = \
-                        bib_entry.entries[label].fields['DOI'][
-                           bib_entry.entries[label].fields['DOI'].rfind('.')+3:
-                                                               ]
-
-
-            # in some cases, get the pages by scraping the journal site
-            scraping_page_journals = ['Nature Communications', 
-                                      'Communications Physics',
-                                      'npj Quantum Materials',
-                                      'npj Computational Materials',
-                                      'npj Quantum Information',
-                                      'npj Nanophotonics',
-                                      'npj Spintronics',
-                                      'Science China Physics, Mechanics',
-                                      'The European Physical Journal',
-                                      'Journal of High Energy Physics', 
-                                      'Scientific Reports',
-                                      'Frontiers of Physics',
-                                      'Nature Reviews Materials',
-                                      'Quantum Frontiers',
-                                      'Light: Science &amp; Applications'
-                                      ]
-
-            for spj in scraping_page_journals:
-                if (bib_entry.entries[label].fields['journal'].find(
-                                                                    spj) == 0):
-                    try:
-                        page = urlopen('http://dx.doi.org/' + DOI)
-                        html_bytes = page.read()
-                        html = html_bytes.decode("utf-8")
-                        html = html[html.find('"article-number">')+17:]
-                        bib_entry.entries[label].fields['pages'] = \
-                            html[:html.find('<')]
-                    except:
-                        pass
-
-            # scraping some of the websites does not work directly in urlopen
-            # so we use crossref
-            experimental_page_journals = ['Applied Physics Letters',
-                                          'Applied Physics Reviews',
-                                          'Journal of Mathematical Physics',
-                                          'AIP Advances',
-                                          'Review of Scientific Instruments',
-                                          'Journal of Applied Physics',
-                                          'The Journal of Chemical Physics',
-                                          'Science',
-                                          'Proceedings of the National Academy of Sciences',
-                                          'Science',
-                                          'Philosophical Transactions of the Royal Society',
-                                          'National Science Review',
-                                          'Communications Materials',
-                                          'Letters in Mathematical Physics',
-                                          'Physical Review', 
-                                          'Reviews of Modern Physics',
-                                          'PRX Quantum',
-                                          'Nanoscale Research Letters',
-                                          'Journal of Nanoparticle Research'
-                                          ]
-
-            if EXPERIMENTAL:
-                for epj in experimental_page_journals:
-                    if (bib_entry.entries[label].fields['journal'].find(
-                                                                    epj) == 0):
-                        pages = get_pages_using_crossref('http://dx.doi.org/' 
-                                                     + DOI, epj)
-                        if pages is not None:
-                            bib_entry.entries[label].fields['pages'] = pages
-
-        # fix capitalization in titles
-        try:
-            bib_entry.entries[label].fields["title"] = "{" + \
-                bib_entry.entries[label].fields["title"] + "}"
-        except:
-            pass
-
-
-        # check if titles have mml:math and change to regular text
-        if "title" in bib_entry.entries[label].fields:
-            fix_title = True
-            mytitle = bib_entry.entries[label].fields["title"]
-
-            while fix_title:
-                ind1 = mytitle.find('<mml')
-                temptitle = mytitle[ind1+3:]
-                ind2 = temptitle.find('>')
-                if ind2 > -1 and ind1 > -1:
-                    mytitle = mytitle[:ind1] + temptitle[ind2+1:]
-                    fix_title = True
-                else:
-                    fix_title = False
-
-            fix_title = True
-            while fix_title:
-                ind1 = mytitle.find('</mml')
-                temptitle = mytitle[ind1+4:]
-                ind2 = temptitle.find('>')
-                if ind2 > -1 and ind1 > -1:
-                    mytitle = mytitle[:ind1] + temptitle[ind2+1:]
-                    fix_title = True
-                else:
-                    fix_title = False
-
-            bib_entry.entries[label].fields["title"] = mytitle
-
-        if "pages" not in bib_entry.entries[label].fields:
-            missing_pages.append((label, 'http://dx.doi.org/' + DOI))
 
+class BibMakerHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers POST /build requests of the server. The body is an input file
+        or, with ?type=bbl, a bbl file. The ?force=1 and ?experimental=1
+        parameters work like the command line options. The answer is the bib
+        file, and the labels of the entries without pages are listed in the
+        X-Missing-Pages header.
+    """
+
+    server_version = 'bib_maker'
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path != '/build':
+            self.send_text(404, 'unknown path ' + parts.path)
+            return
+
+        query = urllib.parse.parse_qs(parts.query)
+
+        def flag(name):
+            return query.get(name, ['0'])[0].lower() in ('1', 'true', 'yes')
+
+        options = Options(verbose=False, force=flag('force'),
+                          experimental=flag('experimental'), jobs=JOBS,
+                          refresh=REFRESH_CACHE, cache=CACHE,
+                          profile=PROFILER, resolvers=RESOLVERS,
+                          fuzzy=FUZZY_THRESHOLD)
+
+        length = int(self.headers.get('Content-Length', 0))
+        infile = io.StringIO(self.rfile.read(length).decode('utf-8',
+                                                            errors='replace'))
+
+        try:
+            if query.get('type', ['list'])[0] == 'bbl':
+                records = BibBuilder(options).iter_build_bbl(infile)
+            else:
+                records = BibBuilder(options).iter_build(
+                                                    read_input_file(infile))
+        except BibMakerError as e:
+            self.send_text(400, str(e))
+            return
+
+        writer = BibWriter(io.StringIO())
+        for record in records:
+            writer.write(record)
+        body = writer.outfile.getvalue().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/x-bibtex; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Missing-Pages',
+                         ' '.join(label for label, url in writer.missing))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, status, text):
+        body = (text + '\n').encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
         if VERBOSE:
-            print(bib_entry.to_string('bibtex'))
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
 
-        print(bib_entry.to_string('bibtex'), file=outfile)
-        print('', file=outfile)
+def serve(port):
+    """ Run the server until it is interrupted. It only listens on the local
+        machine.
+    """
+    # load everything that is shared between the requests now
+    journal_abbreviations()
+    journal_page_rules()
 
-    outfile.close()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port),
+                                             BibMakerHandler)
+    print('### Serving on http://127.0.0.1:' + str(port))
 
-    if len(missing_pages) > 0:
-        print("### Could not fill in 'pages' field for:")
-        for myitem in missing_pages:
-            print(myitem[0], myitem[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
+def build_on_server(url, options):
+    """ Send the input file to the server at url. Returns the bib file and
+        the labels of the entries without pages. The request has its own
+        connection, which waits for as long as the build takes (see
+        SERVER_TIMEOUT), and it is not retried.
+    """
+    with open(INPUT_FILE, 'rb') as infile:
+        body = infile.read()
+
+    query = urllib.parse.urlencode({
+        'type': 'bbl' if INPUT_FILE[-4:] == '.bbl' else 'list',
+        'force': int(options.force),
+        'experimental': int(options.experimental)})
+
+    client = HTTPClient(timeout=SERVER_TIMEOUT, retries=0)
+    try:
+        response = client.post(url.rstrip('/') + '/build?' + query, body,
+                               {'Content-Type': 'text/plain; charset=utf-8'})
+    except HTTPError as e:
+        raise BibMakerError('could not reach the server: ' + str(e))
+    finally:
+        client.close()
+
+    if response.status != 200:
+        raise BibMakerError(response.text().strip())
+
+    return response.text(), response.headers.get('x-missing-pages',
+                                                 '').split()
+
+
+def process_bibfile(options):
+    """ Build the bib file of the command line. In UPDATE mode, the entries
+        that are already in the bib file are kept as they are, and only the
+        other DOIs are fetched. The entries are written in the order of the
+        input file, each one as soon as it is done.
+    """
+    if OVERWRITE or UPDATE:
+        mode = 'w'
+    else:
+        mode = 'a'
 
+    if SERVER is not None:
+        with profile_stage(options, 'server build'):
+            bibtex, missing = build_on_server(SERVER, options)
 
+        if options.verbose:
+            print(bibtex)
 
+        with open(BIB_FILE, mode) as outfile:
+            outfile.write(bibtex)
 
+    else:
+        builder = BibBuilder(options)
+
+        existing = None
+        if UPDATE:
+            existing = read_existing_entries(BIB_FILE)
+
+        # the file is only opened once the DOIs have all been fetched, so
+        # that it is left alone if that fails
+        if INPUT_FILE[-4:] == '.bbl':
+            # the labels and DOIs are only written out if some DOIs are
+            # missing, next to the bbl file
+            records = builder.iter_build_bbl(INPUT_FILE, existing,
+                                             INPUT_FILE[:-4] + '.dois.txt')
+        else:
+            with profile_stage(options, 'read input'):
+                doi_requests = read_input_file(INPUT_FILE)
 
+            if options.verbose:
+                print('### Processing input file')
+                print()
 
+            records = builder.iter_build(doi_requests, existing)
 
+        with open(BIB_FILE, mode) as outfile:
+            writer = BibWriter(outfile, echo=options.verbose)
+            for record in records:
+                writer.write(record)
 
+        missing = [label + ' ' + url for label, url in writer.missing]
 
+    if len(missing) > 0:
+        print("### Could not fill in 'pages' field for:")
+        for myitem in missing:
+            print(myitem)
 
 
 
+def report_profile(profiler):
+    """ Print the profile, and write it to PROFILE_JSON if asked to.
+    """
+    if PROFILE:
+        print(profiler.table())
 
+    if PROFILE_JSON is not None:
+        with open(PROFILE_JSON, 'w') as outfile:
+            json.dump(profiler.report(), outfile, indent=2)
+            outfile.write('\n')
 
 
+def batch_input_files(args):
+    """ The input files of the batch mode: the files given, the files
+        matching the glob patterns, and the bbl files in the directories,
+        without repetitions.
+    """
+    inputfiles = []
+    for arg in args:
+        if os.path.isdir(arg):
+            matches = glob.glob(os.path.join(arg, '**', '*.bbl'),
+                                recursive=True)
+        elif any(char in arg for char in '*?['):
+            matches = glob.glob(arg, recursive=True)
+        else:
+            matches = [arg]
+        inputfiles += sorted(matches)
 
+    return list(dict.fromkeys(inputfiles))
 
 
+def batch_output_file(inputfilename):
+    """ input.bbl -> input.bib, in OUTPUT_DIR if it is set.
+    """
+    bibfilename = os.path.splitext(os.path.basename(inputfilename))[0] + '.bib'
+    if OUTPUT_DIR is not None:
+        return os.path.join(OUTPUT_DIR, bibfilename)
+    return os.path.join(os.path.dirname(inputfilename), bibfilename)
+
+
+def process_batch(options):
+    """ Build the bib files of all the documents of the batch mode. The
+        documents are read in parallel and every DOI is fetched once, then
+        the documents are built one after the other, each one written out an
+        entry at a time. A document that fails does not stop the others, and
+        a summary is printed at the end.
+    """
+    start = time.perf_counter()
+
+    inputfiles = batch_input_files(BATCH_INPUTS)
+    if len(inputfiles) == 0:
+        raise BibMakerError('no input files found')
+
+    bibfiles = [batch_output_file(inputfile) for inputfile in inputfiles]
+    for inputfile, bibfile in zip(inputfiles, bibfiles):
+        if os.path.abspath(inputfile) == os.path.abspath(bibfile):
+            raise BibMakerError(inputfile + ' is already a bib file')
+    if len(set(bibfiles)) < len(bibfiles):
+        raise BibMakerError('several input files have the same name, '
+                            'use them without --output-dir')
+    if OUTPUT_DIR is not None:
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    builder = BibBuilder(options)
+    documents = builder.read_batch(inputfiles)
+    fetched = builder.fetch_batch([document for document in documents
+                                   if not isinstance(document,
+                                                     BibMakerError)])
+
+    # the documents are written one entry at a time, as in
+    # process_bibfile()
+    print('### Batch summary')
+    failed = 0
+    for inputfile, bibfile, document in zip(inputfiles, bibfiles, documents):
+        try:
+            if isinstance(document, BibMakerError):
+                raise document
+
+            records = builder.iter_build(document, fetched=fetched)
+            with open(bibfile, 'w' if OVERWRITE else 'a') as outfile:
+                writer = BibWriter(outfile)
+                for record in records:
+                    writer.write(record)
+        except BibMakerError as e:
+            failed += 1
+            print(inputfile + ': FAILED, ' + str(e))
+            continue
 
+        missing = writer.missing
+        print(inputfile + ' -> ' + bibfile + ': ' + str(writer.count) +
+              ' entries' +
+              (', no pages for ' + ' '.join(label for label, url in missing)
+               if len(missing) > 0 else ''))
 
+    references = [DOI for document in documents
+                  if not isinstance(document, BibMakerError)
+                  for label, DOI in document]
+    print(str(len(inputfiles)) + ' documents, ' + str(len(references)) +
+          ' references, ' + str(len(set(normalize_DOI(DOI)
+                                        for DOI in references))) +
+          ' unique DOIs, ' + str(failed) + ' failed, ' +
+          format(time.perf_counter() - start, '.1f') + ' s')
 
+    if failed > 0:
+        raise BibMakerError(str(failed) + ' of ' + str(len(inputfiles)) +
+                            ' documents failed')
 
 
 def main():
     """
     """
+    global PROFILER
 
     parse_args()
 
-    process_bibfile()
+    if COMPILE_ABBREVIATIONS is not None:
+        try:
+            count = compile_abbreviations(COMPILE_ABBREVIATIONS,
+                                          ABBREVIATIONS_INDEX)
+        except OSError as e:
+            rtfm(str(e))
+        print('### Compiled ' + str(count) + ' journal names into ' +
+              ABBREVIATIONS_INDEX)
+        return
 
-    abbreviate_journal_names(BIB_FILE)
+    open_cache()
+
+    if PROFILE or PROFILE_JSON is not None:
+        PROFILER = Profiler()
+        http_client().profile = PROFILER
+
+    try:
+        open_resolvers()
+
+        options = Options(verbose=VERBOSE, force=FORCE,
+                          experimental=EXPERIMENTAL, jobs=JOBS,
+                          refresh=REFRESH_CACHE, cache=CACHE,
+                          profile=PROFILER, resolvers=RESOLVERS,
+                          fuzzy=FUZZY_THRESHOLD)
+
+        if SERVE:
+            serve(PORT)
+        elif BATCH:
+            process_batch(options)
+        elif INPUT_FILE is not None:
+            process_bibfile(options)
+
+        report_fuzzy_matches()
+    except BibMakerError as e:
+        rtfm(str(e))
+    finally:
+        close_resolvers()
+        close_cache()
+        set_http_client(None)
+        if PROFILER is not None:
+            report_profile(PROFILER)
 
 
 if __name__ == '__main__':